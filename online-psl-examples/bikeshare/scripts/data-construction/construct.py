@@ -3,16 +3,27 @@ Construct PSL formatted data from raw bikehsare data.
 """
 
 import datetime
+import hashlib
 import numpy as np
 import os
 import pandas as pd
 import shutil
+import sys
+
+from multiprocessing import Pool
 
 import predicate_constructors
 
 DIRNAME = os.path.dirname(__file__)
 DATA_PATH = os.path.join(DIRNAME, "../../data")
 PSL_DATA_PATH = os.path.join(DIRNAME, "../../data/bikeshare")
+CACHE_PATH = os.path.join(DIRNAME, "../../data/cache")
+# Version of the parsing done by each raw data loader, bump it when the loader changes to invalidate its cache.
+LOADER_VERSIONS = {"load_stations": 1, "load_status": 2, "load_trips": 1, "load_weather": 1}
+ZIPCODE_CACHE_PATH = os.path.join(CACHE_PATH, "zipcode_geocodes.csv")
+
+# Time steps between full refits of the ARIMA parameters, in between the model is only updated with new observations.
+ARIMA_REFIT_INTERVAL = 4
 
 OVERLAPPING_FOLDS = True
 NUM_FOLDS = 10
@@ -46,8 +57,16 @@ FILE_INFO_MAP = {"ARIMA_obs.txt": ("ARIMA", OBS, False),
                  "Demand_target.txt": ("Demand", TARGET, True),
                  "Target_obs.txt": ("Target", TARGET, True)}
 
+# Predicates that are the same for every time step of a fold.
+STATIC_PREDICATE_FILES = ["IsHour_obs.txt", "IsDayOfWeek_obs.txt", "IsWeekend_obs.txt",
+                          "Station_obs.txt", "Nearby_obs.txt", "Commute_obs.txt"]
 
-def construct_predicates():
+
+def construct_predicates(jobs=1):
+    """
+    Construct the PSL data of every fold.
+    :param jobs: The number of processes that construct folds concurrently.
+    """
     # Load the raw data.
     station_df, status_df, trip_df, weather_df = load_dataframes()
 
@@ -77,55 +96,75 @@ def construct_predicates():
                               split_dates[idx][0][1] + datetime.timedelta(days=(i + 1) * days_per_split)]
                              for i in range(NUM_PARTITIONS)]
 
-    for fold in range(NUM_FOLDS):
-        print("Constructing fold #" + str(fold))
-
-        fold_status_df = status_df[(status_df.time.dt.date >= fold_dates[fold][0]) &
-                                   (status_df.time.dt.date <= fold_dates[fold][1])]
-        fold_trip_df = trip_df[(trip_df.end_date.dt.date >= fold_dates[fold][0]) &
-                               (trip_df.end_date.dt.date <= fold_dates[fold][1])]
-        fold_weather_df = weather_df[(weather_df.date.dt.date >= fold_dates[fold][0]) &
-                                     (weather_df.date.dt.date <= fold_dates[fold][1])]
-
-        # Construct demand dataframe for fold.
-        # Demand is defined as the number trips starting at a stations over the that stations dock count.
-        # Values are clipped to the range [0, 1].
-        fold_trip_df_subset = fold_trip_df.loc[:, ['start_station_id', 'start_date', 'id']]
-        fold_trip_df_subset.start_date = fold_trip_df_subset.start_date.dt.floor("60min")
-        demand_df = fold_trip_df_subset.groupby(['start_station_id', 'start_date']).count().reset_index()
-        demand_df.columns = ['station_id', 'time', 'demand']
-        demand_df.demand = np.clip(demand_df.demand / station_df.loc[demand_df.station_id, 'dock_count'].values,
-                                   0.0, 1.0)
-
-        # Fill in missing data ranges.
-        demand_df = demand_df.append(pd.DataFrame(data={'station_id': -1, 'time': status_df.time.unique(), 'demand': 0}))
-        demand_df = demand_df.set_index(['station_id', 'time']).unstack(fill_value=0).stack().reset_index()
-        demand_df.drop(demand_df[demand_df.station_id == -1].index, inplace=True)
-
-        # Instantiate predicate constructor object.
-        predicate_constructor = predicate_constructors.predicate_constructor(demand_df)
-        out_directory = PSL_DATA_PATH + '/bikeshare_time_series/' + str(int(fold)).zfill(2) + '/eval/'
-
-        print("Making " + out_directory)
-        if not os.path.exists(out_directory):
-            os.makedirs(out_directory)
-
-        # Construct predicates that are static for this fold.
-        print("Constructing static predicates.")
-        construct_static_predicates(predicate_constructor, station_df, fold_weather_df, fold_status_df, fold_trip_df,
-                                    split_dates[fold], out_directory)
-
-        # Construct predicates that are dynamic for this fold.
-        print("Constructing dynamic predicates.")
-        construct_dynamic_predicates(predicate_constructor, station_df, fold_weather_df, fold_status_df, fold_trip_df,
-                                demand_df, split_dates[fold], out_directory)
-
-
-def construct_client_commands(predicate_constructor,
-                              prev_observed_demands, current_observed_demands,
-                              prev_truth_demands, current_truth_demands,
-                              prev_observed_raining, current_observed_raining,
-                              prev_observed_ARIMA, current_observed_ARIMA,
+    if jobs <= 1:
+        for fold in range(NUM_FOLDS):
+            construct_fold(fold, fold_dates[fold], split_dates[fold], station_df, status_df, trip_df, weather_df)
+    else:
+        # The input frames are sent to each worker once rather than with every fold.
+        with Pool(jobs, initializer=_init_fold_worker, initargs=(station_df, status_df, trip_df, weather_df)) as pool:
+            pool.starmap(_construct_fold_worker, [(fold, fold_dates[fold], split_dates[fold]) for fold in range(NUM_FOLDS)])
+
+
+def construct_fold(fold, fold_dates, split_dates, station_df, status_df, trip_df, weather_df):
+    """
+    Construct the data of one fold.
+    Folds are independent, so they can be constructed in any order or concurrently.
+    """
+    print("Constructing fold #" + str(fold))
+
+    fold_status_df = status_df[(status_df.time.dt.date >= fold_dates[0]) &
+                               (status_df.time.dt.date <= fold_dates[1])]
+    fold_trip_df = trip_df[(trip_df.end_date.dt.date >= fold_dates[0]) &
+                           (trip_df.end_date.dt.date <= fold_dates[1])]
+    fold_weather_df = weather_df[(weather_df.date.dt.date >= fold_dates[0]) &
+                                 (weather_df.date.dt.date <= fold_dates[1])]
+
+    # Construct demand dataframe for fold.
+    # Demand is defined as the number trips starting at a stations over the that stations dock count.
+    # Values are clipped to the range [0, 1].
+    fold_trip_df_subset = fold_trip_df.loc[:, ['start_station_id', 'start_date', 'id']]
+    fold_trip_df_subset.start_date = fold_trip_df_subset.start_date.dt.floor("60min")
+    demand_df = fold_trip_df_subset.groupby(['start_station_id', 'start_date']).count().reset_index()
+    demand_df.columns = ['station_id', 'time', 'demand']
+    demand_df.demand = np.clip(demand_df.demand / station_df.loc[demand_df.station_id, 'dock_count'].values,
+                               0.0, 1.0)
+
+    # Fill in missing data ranges.
+    # The grid holds every station with trips at every status and trip time, with 0 demand where there were no trips.
+    demand_times = predicate_constructors.predicate_constructor.time_axis(pd.concat([status_df.time, demand_df.time]))
+    demand = predicate_constructors.demand_grid(demand_df, demand_times)
+
+    # Instantiate predicate constructor object.
+    predicate_constructor = predicate_constructors.predicate_constructor(demand_times, zipcode_cache_path=ZIPCODE_CACHE_PATH,
+                                                                         arima_refit_interval=ARIMA_REFIT_INTERVAL)
+    out_directory = PSL_DATA_PATH + '/bikeshare_time_series/' + str(int(fold)).zfill(2) + '/eval/'
+
+    print("Making " + out_directory)
+    os.makedirs(out_directory, exist_ok=True)
+
+    # Construct predicates that are static for this fold.
+    print("Constructing static predicates.")
+    construct_static_predicates(predicate_constructor, station_df, fold_weather_df, fold_status_df, fold_trip_df,
+                                split_dates, out_directory)
+
+    # Construct predicates that are dynamic for this fold.
+    print("Constructing dynamic predicates.")
+    construct_dynamic_predicates(predicate_constructor, station_df, fold_weather_df, fold_status_df, fold_trip_df,
+                                 demand, split_dates, out_directory)
+
+
+def _init_fold_worker(station_df, status_df, trip_df, weather_df):
+    global _worker_dataframes
+    _worker_dataframes = (station_df, status_df, trip_df, weather_df)
+
+
+def _construct_fold_worker(fold, fold_dates, split_dates):
+    construct_fold(fold, fold_dates, split_dates, *_worker_dataframes)
+
+
+def construct_client_commands(predicate_constructor, demand,
+                              new_observed_time_range, prev_target_time_range, current_target_time_range,
+                              current_observed_raining, current_observed_ARIMA,
                               time_step):
     add_targets_command_list = []
     add_observation_command_list = []
@@ -134,41 +173,38 @@ def construct_client_commands(predicate_constructor,
 
     if time_step > 0:
         # Demand.
-        new_targets_df = current_truth_demands.loc[current_truth_demands.index.difference(prev_truth_demands.index)].reset_index()
+        # Splits move forward in time, so new targets are the target times after the previous target range.
+        new_targets_df = demand.frame([(max(current_target_time_range[0], prev_target_time_range[1]),
+                                        current_target_time_range[1])])
         add_targets_command_list += df_to_command(
-            predicate_constructor.time_to_int_ids(new_targets_df.loc[:, ['station_id', 'time']]),
+            predicate_constructor.time_to_int_ids(new_targets_df.loc[:, ['station_id', 'time']], inplace=True),
             new_targets_df.loc[:, []],
             ADD, TARGET, 'Demand')
 
-        new_observed_demands_df = current_observed_demands.loc[
-            current_observed_demands.index.difference(prev_observed_demands.index)].reset_index()
+        new_observed_demands_df = demand.frame([new_observed_time_range])
         observe_command_list += df_to_command(
-            predicate_constructor.time_to_int_ids(new_observed_demands_df.loc[:, ['station_id', 'time']]),
+            predicate_constructor.time_to_int_ids(new_observed_demands_df.loc[:, ['station_id', 'time']], inplace=True),
             new_observed_demands_df.loc[:, ['demand']],
             OBSERVE, OBS, 'Demand')
 
         # Target.
-        new_target_df = current_truth_demands.loc[
-            current_truth_demands.index.difference(prev_truth_demands.index)].reset_index()
         add_observation_command_list += df_to_command(
-            predicate_constructor.time_to_int_ids(new_target_df.loc[:, ['station_id', 'time']]),
-            new_target_df.loc[:, ['demand']].clip(1, 1),
+            predicate_constructor.time_to_int_ids(new_targets_df.loc[:, ['station_id', 'time']], inplace=True),
+            new_targets_df.loc[:, ['demand']].clip(1, 1),
             ADD, OBS, 'Target')
 
         # Raining.
-        new_observed_raining_df = current_observed_raining.loc[
-            current_observed_raining.index.difference(prev_observed_raining.index)].reset_index()
+        # Raining is constructed for the current targets, none of which were targets in the previous time step.
         add_observation_command_list += df_to_command(
-            predicate_constructor.time_to_int_ids(new_observed_raining_df.loc[:, ['station_id', 'time']]),
-            new_observed_raining_df.loc[:, ['raining']].clip(1, 1),
+            predicate_constructor.time_to_int_ids(current_observed_raining.loc[:, ['station_id', 'time']], inplace=True),
+            current_observed_raining.loc[:, ['raining']],
             ADD, OBS, 'Raining')
 
         # ARIMA.
-        new_observed_ARIMA_df = current_observed_ARIMA.loc[
-            current_observed_ARIMA.index.difference(prev_observed_ARIMA.index)].reset_index()
+        # Forecasts are made for the current target times, none of which were forecast in the previous time step.
         add_observation_command_list += df_to_command(
-            predicate_constructor.time_to_int_ids(new_observed_ARIMA_df.loc[:, ['time']]),
-            new_observed_ARIMA_df.loc[:, ['ARIMA_Predictions']].clip(1, 1),
+            predicate_constructor.time_to_int_ids(current_observed_ARIMA.loc[:, ['time']], inplace=True),
+            current_observed_ARIMA.loc[:, ['ARIMA_Predictions']],
             ADD, OBS, 'ARIMA')
 
     command_list = (add_targets_command_list + observe_command_list +
@@ -177,7 +213,7 @@ def construct_client_commands(predicate_constructor,
     return command_list
 
 
-def construct_dynamic_predicates(predicate_constructor, station_df, weather_df, status_df, trip_df, demand_df,
+def construct_dynamic_predicates(predicate_constructor, station_df, weather_df, status_df, trip_df, demand,
                                  split_dates, out_directory):
     """
     Construct the predicates change between timesteps.
@@ -186,13 +222,11 @@ def construct_dynamic_predicates(predicate_constructor, station_df, weather_df,
     path = out_directory
 
     # Initialize observations.
-    # This dataframe will grow with each timestep by adding some or all of the previous timestep's target set.
-    aggregated_observed_demand_df = pd.DataFrame(columns=demand_df.columns)
-    aggregated_observed_demand_df = aggregated_observed_demand_df.append(
-        demand_df[(demand_df["time"].dt.date > split_dates[0][0]) &
-                  (demand_df["time"].dt.date < split_dates[0][1])])
-    target_demands_df = demand_df[(demand_df["time"].dt.date > split_dates[1][0]) &
-                                  (demand_df["time"].dt.date < split_dates[1][1])]
+    # This list of time ranges will grow with each timestep by adding some or all of the previous timestep's target set.
+    observed_time_ranges = [demand.time_range(split_dates[0])]
+    target_time_range = demand.time_range(split_dates[1])
+    aggregated_observed_demand_df = demand.frame(observed_time_ranges)
+    target_demands_df = demand.frame([target_time_range])
 
     # Initialize empty list of commands.
     command_list = []
@@ -205,25 +239,17 @@ def construct_dynamic_predicates(predicate_constructor, station_df, weather_df,
             os.makedirs(path)
 
         if time_step == 0:
-            # Initialize raining and ARIMA dfs for 0th timestep.
-            # Raining
-            raining_df = predicate_constructor.raining_predicate(weather_df, station_df, target_demands_df, path)
-
-            # Arima
+            # Initialize ARIMA df for 0th timestep.
             ARIMA_df = predicate_constructor.arima_predicate(aggregated_observed_demand_df, target_demands_df, path)
 
         # Update timestep observations and targets.
-        prev_observed_demand_df = aggregated_observed_demand_df.copy()
-        prev_target_demand_df = target_demands_df.copy()
-        prev_raining_df = raining_df.copy()
-        prev_ARIMA_df = ARIMA_df.copy()
+        prev_target_time_range = target_time_range
 
         if time_step > 0:
-            aggregated_observed_demand_df = aggregated_observed_demand_df.append(
-                demand_df[(demand_df["time"].dt.date > split_dates[time_step][0]) &
-                          (demand_df["time"].dt.date < split_dates[time_step][1])])
-            target_demands_df = demand_df[(demand_df["time"].dt.date > split_dates[time_step + 1][0]) &
-                                      (demand_df["time"].dt.date < split_dates[time_step + 1][1])]
+            observed_time_ranges.append(demand.time_range(split_dates[time_step]))
+            target_time_range = demand.time_range(split_dates[time_step + 1])
+            aggregated_observed_demand_df = demand.frame(observed_time_ranges)
+            target_demands_df = demand.frame([target_time_range])
 
         # Demand
         predicate_constructor.demand_predicate(aggregated_observed_demand_df, path, OBS)
@@ -231,7 +257,7 @@ def construct_dynamic_predicates(predicate_constructor, station_df, weather_df,
         predicate_constructor.demand_predicate(target_demands_df, path, TRUTH)
 
         # Target
-        predicate_constructor.target_predicate(aggregated_observed_demand_df.append(target_demands_df), path, OBS)
+        predicate_constructor.target_predicate(demand.frame(observed_time_ranges + [target_time_range]), path, OBS)
 
         # Arima
         ARIMA_df = predicate_constructor.arima_predicate(aggregated_observed_demand_df, target_demands_df, path)
@@ -241,11 +267,9 @@ def construct_dynamic_predicates(predicate_constructor, station_df, weather_df,
 
 
         # Get client commands for this timestep.
-        command_list += construct_client_commands(predicate_constructor,
-                                                  prev_observed_demand_df, aggregated_observed_demand_df,
-                                                  prev_target_demand_df, target_demands_df,
-                                                  prev_raining_df, raining_df,
-                                                  prev_ARIMA_df, ARIMA_df,
+        command_list += construct_client_commands(predicate_constructor, demand,
+                                                  observed_time_ranges[-1], prev_target_time_range, target_time_range,
+                                                  raining_df, ARIMA_df,
                                                   time_step)
 
     command_list += ["STOP"]
@@ -266,9 +290,7 @@ def construct_static_predicates(predicate_constructor, station_df, weather_df, s
 
     # Time related predicates.
     # Status is only used for time information in these predicates.
-    predicate_constructor.ishour_predicate(status_df.loc[:, ["station_id", "time"]], path)
-    predicate_constructor.isdayofweek_predicate(status_df.loc[:, ["station_id", "time"]], path)
-    predicate_constructor.isweekend_predicate(status_df.loc[:, ["station_id", "time"]], path)
+    predicate_constructor.time_predicates(status_df.loc[:, ["station_id", "time"]], path)
 
     # Location / station related predicates.
     predicate_constructor.station_predicate(station_df, path)
@@ -282,82 +304,82 @@ def construct_static_predicates(predicate_constructor, station_df, weather_df, s
         if not os.path.exists(cp_path):
             os.makedirs(cp_path)
 
-        shutil.copy(os.path.join(path, "IsHour_obs.txt"), os.path.join(cp_path, "IsHour_obs.txt"))
-        shutil.copy(os.path.join(path, "IsDayOfWeek_obs.txt"), os.path.join(cp_path, "IsDayOfWeek_obs.txt"))
-        shutil.copy(os.path.join(path, "IsWeekend_obs.txt"), os.path.join(cp_path, "IsWeekend_obs.txt"))
+        link_static_predicates(path, cp_path, STATIC_PREDICATE_FILES)
 
-        shutil.copy(os.path.join(path, "Station_obs.txt"), os.path.join(cp_path, "Station_obs.txt"))
-        shutil.copy(os.path.join(path, "Nearby_obs.txt"), os.path.join(cp_path, "Nearby_obs.txt"))
-        shutil.copy(os.path.join(path, "Commute_obs.txt"), os.path.join(cp_path, "Commute_obs.txt"))
 
+def link_static_predicates(source_path, destination_path, file_names):
+    """
+    Share static predicate files between directories.
+    Files are hard linked so the data is stored once, and copied if the file system does not support hard links.
+    """
+    for file_name in file_names:
+        source_file = os.path.join(source_path, file_name)
+        destination_file = os.path.join(destination_path, file_name)
+
+        if os.path.exists(destination_file):
+            os.remove(destination_file)
+
+        try:
+            os.link(source_file, destination_file)
+        except OSError:
+            shutil.copy(source_file, destination_file)
 
-def command_file_write(command_list, path):
-    command_str = ''
-    for command in command_list:
-        command_str += command + '\n'
 
+def command_file_write(command_list, path, chunk_size=100000):
     if not os.path.exists(path):
         os.makedirs(path)
 
+    # Write the commands in chunks rather than building the whole file in memory.
     with open(os.path.join(path, 'commands.txt'), 'w') as writer:
-        writer.write(command_str)
+        for start in range(0, len(command_list), chunk_size):
+            writer.write('\n'.join(command_list[start:start + chunk_size]) + '\n')
 
 
 def df_to_command(constants_df, value_series, action_type, partition_name, predicate_name):
-    command_list = []
     assert(constants_df.shape[0] == value_series.shape[0])
 
-    for idx, row in constants_df.iterrows():
-        predicate_constants = row.values
-        if value_series.loc[idx].shape[0] != 0:
-            value = value_series.loc[idx].values[0]
-        else:
-            value = None
-        command_list += [create_command_line(action_type, partition_name, predicate_name, predicate_constants, value)]
-    return command_list
+    # Quote and join the predicate constants one column at a time.
+    constants = pd.Series("", index=np.arange(constants_df.shape[0]), dtype=object)
+    for column_number in range(constants_df.shape[1]):
+        if column_number > 0:
+            constants = constants + ","
+        constants = constants + "'" + constants_df.iloc[:, column_number].astype(str).values + "'"
 
+    if value_series.shape[1] != 0:
+        values = pd.Series(value_series.iloc[:, 0].astype(str).values, index=constants.index)
+    else:
+        values = None
+
+    return create_command_lines(action_type, partition_name, predicate_name, constants, values).tolist()
 
-def create_command_line(action_type, partition_name, predicate_name, predicate_constants, value):
+
+def create_command_lines(action_type, partition_name, predicate_name, constants, values):
     if partition_name == OBS:
         partition_str = "READ"
     elif partition_name == TARGET:
         partition_str = "WRITE"
 
-    quoted_predicate_constants = ["'" + str(const) + "'" for const in predicate_constants]
-    constants_list = ",".join(quoted_predicate_constants)
-    
     if action_type == ADD:
-        if value is not None:
-            return ADD + "\t" + partition_str + "\t" + predicate_name + "(" + constants_list + ")\t" + str(value)
+        if values is not None:
+            return ADD + "\t" + partition_str + "\t" + predicate_name + "(" + constants + ")\t" + values
         else:
-            return ADD + "\t" + partition_str + "\t" + predicate_name + "(" + constants_list + ")"
+            return ADD + "\t" + partition_str + "\t" + predicate_name + "(" + constants + ")"
 
     if action_type == OBSERVE:
-        return OBSERVE + "\t" + predicate_name + "(" + constants_list + ")\t" + str(value)
+        return OBSERVE + "\t" + predicate_name + "(" + constants + ")\t" + values
 
     elif action_type == UPDATE:
-        return UPDATE + "\t" + predicate_name + "(" + constants_list + ")\t" + str(value)
+        return UPDATE + "\t" + predicate_name + "(" + constants + ")\t" + values
 
     elif action_type == DELETE:
-        return DELETE + "\t" + partition_str + "\t" + predicate_name + "(" + constants_list + ")"
+        return DELETE + "\t" + partition_str + "\t" + predicate_name + "(" + constants + ")"
 
 
 def load_dataframes():
-    station_df = pd.read_csv(DATA_PATH + "/bikeshare_raw/station.csv", sep=',', encoding="ISO-8859-1", engine='python')
-    station_df = station_df.set_index('id')
-
-    # Status df contains data about the station on a minute frequency.
-    status_df = pd.read_csv(DATA_PATH + "/bikeshare_raw/status.csv", sep=',', encoding="ISO-8859-1", engine='python',
-            parse_dates=['time'], infer_datetime_format=True)
-    # Aggregate status entries to the hour.
-    status_df.time = status_df.time.dt.floor('60min')
-    status_df = status_df.groupby(['station_id', 'time']).mean().reset_index()
-
-    trip_df = pd.read_csv(DATA_PATH + "/bikeshare_raw/trip.csv", sep=',', encoding="ISO-8859-1", engine='python',
-                          parse_dates=['start_date', 'end_date'], infer_datetime_format=True)
-
-    weather_df = pd.read_csv(DATA_PATH + "/bikeshare_raw/weather.csv", sep=',', encoding="ISO-8859-1", engine='python',
-                             parse_dates=['date'], infer_datetime_format=True)
+    station_df = cached_load(DATA_PATH + "/bikeshare_raw/station.csv", load_stations)
+    status_df = cached_load(DATA_PATH + "/bikeshare_raw/status.csv", load_status)
+    trip_df = cached_load(DATA_PATH + "/bikeshare_raw/trip.csv", load_trips)
+    weather_df = cached_load(DATA_PATH + "/bikeshare_raw/weather.csv", load_weather)
 
     # filter status and station that do not exist in early trip_df
     station_df = station_df[:-2]
@@ -368,9 +390,88 @@ def load_dataframes():
     return station_df, status_df, trip_df, weather_df
 
 
-def main():
-    construct_predicates()
+def load_stations(path):
+    station_df = pd.read_csv(path, sep=',', encoding="ISO-8859-1")
+    return station_df.set_index('id')
+
+
+def load_status(path, chunk_size=10 ** 6):
+    # Status df contains data about the station on a minute frequency.
+    # Aggregate status entries to the hour one chunk at a time with sums and counts of each (station, hour),
+    # so the minute level data is never held in memory at once.
+    hourly_sums = []
+    hourly_counts = []
+    for status_chunk in pd.read_csv(path, sep=',', encoding="ISO-8859-1",
+                                    parse_dates=['time'], infer_datetime_format=True, chunksize=chunk_size):
+        status_chunk.time = status_chunk.time.dt.floor('60min')
+        grouped_status_chunk = status_chunk.groupby(['station_id', 'time'])
+        hourly_sums.append(grouped_status_chunk.sum())
+        hourly_counts.append(grouped_status_chunk.count())
+
+    # An hour may span chunks, so the chunk totals are combined before averaging.
+    hourly_sums = pd.concat(hourly_sums).groupby(level=['station_id', 'time']).sum()
+    hourly_counts = pd.concat(hourly_counts).groupby(level=['station_id', 'time']).sum()
+    return (hourly_sums / hourly_counts).reset_index()
+
+
+def load_trips(path):
+    return pd.read_csv(path, sep=',', encoding="ISO-8859-1",
+                       parse_dates=['start_date', 'end_date'], infer_datetime_format=True)
+
+
+def load_weather(path):
+    return pd.read_csv(path, sep=',', encoding="ISO-8859-1",
+                       parse_dates=['date'], infer_datetime_format=True)
+
+
+def cached_load(raw_path, load_function):
+    """
+    Load a raw input file through a binary cache of its parsed frame.
+    The cache is keyed by a hash of the raw file and the loader's name and version,
+    so a changed raw file or loader is parsed again.
+    Pickled frames keep their dtypes and indexes and load without any parsing.
+    """
+    cache_file = os.path.join(CACHE_PATH, "{}.{}.v{}.{}.pkl".format(os.path.basename(raw_path), load_function.__name__,
+                                                                    LOADER_VERSIONS[load_function.__name__],
+                                                                    file_hash(raw_path)))
+    if os.path.exists(cache_file):
+        return pd.read_pickle(cache_file)
+
+    data = load_function(raw_path)
+
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    data.to_pickle(cache_file)
+    return data
+
+
+def file_hash(path, chunk_size=2 ** 20):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def main(jobs):
+    construct_predicates(jobs=jobs)
+
+
+def _load_args(args):
+    executable = args.pop(0)
+    jobs = 1
+
+    # Other arguments, like the data directory passed by construct.sh, are ignored.
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg.lower().strip().replace('-', '') in {'h', 'help'}:
+            print("USAGE: python3 %s [--jobs <number of processes>]" % (executable), file=sys.stderr)
+            sys.exit(1)
+
+        if arg in {'-j', '--jobs'}:
+            jobs = int(args.pop(0))
+
+    return jobs
 
 
 if __name__ == '__main__':
-    main()
+    main(_load_args(sys.argv))
@@ -7,28 +7,102 @@ import os
 import pandas as pd
 import pgeocode
 import time
+import warnings
 
 from multiprocessing import Pool
+from scipy import sparse
 from sklearn.metrics.pairwise import haversine_distances
+from sklearn.neighbors import BallTree
 from statsmodels.tsa.statespace.sarimax import SARIMAX
 
 
 
-class predicate_constructor:
-    time_to_constant_dict = {}
+class demand_grid:
+    """
+    Demand of stations at times as a dense stations x times array.
+    (station, time) pairs without demand have demand 0.
+    """
+
+    def __init__(self, demand_df, times):
+        """
+        :param demand_df: Demand with station_id, time and demand columns.
+        :param times: Sorted DatetimeIndex of the times of the grid, including every time in demand_df.
+        """
+        self.station_ids = np.unique(demand_df.station_id.values)
+        self.times = times
+        self.values = np.zeros((len(self.station_ids), len(self.times)))
+        self.values[np.searchsorted(self.station_ids, demand_df.station_id.values),
+                    self.times.searchsorted(pd.DatetimeIndex(demand_df.time))] = demand_df.demand.values
+
+    def time_range(self, split_date_range):
+        """
+        Get the [start, end) positions of the times strictly between the dates of a split.
+        """
+        start = self.times.searchsorted(pd.Timestamp(split_date_range[0]) + pd.Timedelta(days=1), side='left')
+        end = self.times.searchsorted(pd.Timestamp(split_date_range[1]), side='left')
+        return start, end
+
+    def frame(self, time_ranges):
+        """
+        Get the demand of every station at the times of the ranges, ordered by time and then station.
+        :param time_ranges: List of [start, end) time positions.
+        """
+        time_positions = np.concatenate([np.arange(start, end) for start, end in time_ranges])
+        return pd.DataFrame({'station_id': np.tile(self.station_ids, len(time_positions)),
+                             'time': np.repeat(self.times[time_positions], len(self.station_ids)),
+                             'demand': self.values[:, time_positions].T.ravel()})
 
-    def __init__(self, demand_df):
-        self.time_to_constant_dict = dict(zip(np.sort(demand_df.time.unique()),
-                                              np.arange(len(demand_df.time.unique()), dtype=int)))
 
-    def time_to_int_ids(self, data):
-        data_copy = data.copy(deep=True)
+class predicate_constructor:
+    time_values = np.array([], dtype=np.int64)
+
+    def __init__(self, times, zipcode_cache_path=None, arima_refit_interval=1, arima_drift_warning=0.05):
+        """
+        :param times: Every time of the fold.
+        :param zipcode_cache_path: Optional csv file of zip code geocodes to read and extend instead of querying pgeocode.
+        :param arima_refit_interval: Number of ARIMA updates with new observations between full refits of its parameters.
+        :param arima_drift_warning: Diagnostic only, warn when the warm started ARIMA forecast differs from the refit one
+                                    by more than this at a refit. The refit forecast is used either way.
+        """
+        # The int id of a time is its position in the sorted unique times, as int64 nanoseconds.
+        self.time_values = self.time_axis(times).asi8
+        self.zipcode_cache_path = zipcode_cache_path
+        self.zip_to_station = None
+
+        self.arima_refit_interval = arima_refit_interval
+        self.arima_drift_warning = arima_drift_warning
+        self.arima_results = None
+        self.arima_last_time = None
+        self.arima_observed_length = 0
+        self.arima_updates = 0
+
+    @staticmethod
+    def time_axis(times):
+        """
+        Sorted unique times as a nanosecond DatetimeIndex.
+        """
+        return pd.DatetimeIndex(pd.unique(times.values)).astype('datetime64[ns]').sort_values()
+
+    def time_to_int_ids(self, data, inplace=False):
+        """
+        Convert the datetime columns of data to int time ids.
+        :param inplace: Replace the columns of data itself instead of those of a shallow copy.
+        """
+        if not inplace:
+            data = data.copy(deep=False)
 
         # Convert times to int ids.
-        for col in data_copy.select_dtypes(include=np.datetime64).columns:
-            data_copy[col] = data_copy[col].map(self.time_to_constant_dict)
+        for col in data.select_dtypes(include=np.datetime64).columns:
+            values = data[col].values.astype('datetime64[ns]').view(np.int64)
+            ids = np.searchsorted(self.time_values, values)
+
+            unknown = (ids == len(self.time_values)) | (self.time_values[np.minimum(ids, len(self.time_values) - 1)] != values)
+            if unknown.any():
+                raise ValueError("Unknown times in column {}: {}".format(col, data[col].values[unknown][:5]))
 
-        return data_copy
+            data[col] = ids
+
+        return data
 
     def write(self, data, predicate_name, path):
         data_copy = self.time_to_int_ids(data)
@@ -36,24 +110,24 @@ class predicate_constructor:
         # Path to this file relative to caller
         data_copy.to_csv(os.path.join(path, predicate_name + '.txt'), sep='\t', header=False, index=False)
 
-    def ishour_predicate(self, status_df, path):
-        unique_times = status_df.time.unique()
-        ishour_df = pd.DataFrame(data={'time': unique_times,
-                                       'hour': [pd.Timestamp(t).hour for t in unique_times],
+    def time_predicates(self, status_df, path):
+        """
+        Write the IsHour, IsDayOfWeek and IsWeekend predicates of every time in status_df.
+        """
+        time_axis = self.time_axis(status_df.time)
+
+        ishour_df = pd.DataFrame(data={'time': time_axis,
+                                       'hour': time_axis.hour,
                                        'value': 1})
         self.write(ishour_df, "IsHour_obs", path)
 
-    def isdayofweek_predicate(self, status_df, path):
-        unique_times = status_df.time.unique()
-        sameweekday_df = pd.DataFrame(data={'time': unique_times,
-                                            'day': [pd.Timestamp(t).dayofweek for t in unique_times],
+        isdayofweek_df = pd.DataFrame(data={'time': time_axis,
+                                            'day': time_axis.dayofweek,
                                             'value': 1})
-        self.write(sameweekday_df, "IsDayOfWeek_obs", path)
+        self.write(isdayofweek_df, "IsDayOfWeek_obs", path)
 
-    def isweekend_predicate(self, status_df, path):
-        unique_times = status_df.time.unique()
-        isweekend_df = pd.DataFrame(data={'time': unique_times,
-                                          'isWeekend': [np.floor(pd.Timestamp(t).dayofweek / 5) for t in unique_times]})
+        isweekend_df = pd.DataFrame(data={'time': time_axis,
+                                          'isWeekend': (time_axis.dayofweek // 5).astype(float)})
         self.write(isweekend_df, "IsWeekend_obs", path)
 
     def station_predicate(self, station_df, path):
@@ -61,18 +135,14 @@ class predicate_constructor:
                                       'value': 1}), "Station_obs", path)
 
     def nearby_predicate(self, station_df, path, n=5):
-        distances_df = pd.DataFrame(data=haversine_distances(station_df.loc[:, ['lat', 'long']]),
-                                    index=station_df.index, columns=station_df.index)
-
-        # Keep top 5 closest for each station
-        # take top n for each movie to define pairwise blocks
-        top_n_frame = pd.DataFrame(index=station_df.index, columns=range(5))
-        for m in station_df.index:
-            top_n_frame.loc[m, :] = distances_df.loc[m].nsmallest(n).index
-
-        flattened_frame = top_n_frame.values.flatten()
-        distance_index = np.array([[i] * n for i in station_df.index]).flatten()
-        distance_index = pd.MultiIndex.from_arrays([distance_index, flattened_frame])
+        # Keep the n closest stations to each station, the station itself included.
+        # Ball tree haversine distances expect (latitude, longitude) in radians.
+        station_coordinates = np.radians(station_df.loc[:, ['lat', 'long']].values.astype(float))
+        k = min(n, station_df.shape[0])
+        _, nearest_indices = BallTree(station_coordinates, metric='haversine').query(station_coordinates, k=k)
+
+        distance_index = pd.MultiIndex.from_arrays([np.repeat(station_df.index.values, k),
+                                                    station_df.index.values[nearest_indices.flatten()]])
         nearby_series = pd.Series(data=1, index=distance_index)
 
         self.write(nearby_series.reset_index(), 'Nearby_obs', path)
@@ -82,25 +152,30 @@ class predicate_constructor:
         # Filter trips to those between 6am and 7pm on weekdays (common work hours).
         filtered_trip_df = trip_df[(trip_df.start_date.dt.hour > 6) &
                                    (trip_df.start_date.dt.hour < 19) &
-                                   (trip_df.start_date.dt.day > 4)]
-
-        # Count the number of relevant trips between stations.
-        trip_count_df = filtered_trip_df.loc[:, ["id", "start_station_id", "end_station_id"]].groupby(
-            ["start_station_id", "end_station_id"]).count()
-        trip_count_df.columns = ["count"]
-
-        # Fill return count
-        trip_count_df = trip_count_df.reindex(trip_count_df.index.union(trip_count_df.swaplevel().index), fill_value=0.0)
-        trip_count_df.loc[:, "return_count"] = trip_count_df.loc[trip_count_df.swaplevel().index, "count"].values
-
-        # Filter out station pairs that do not meet commute thresholds.
-        commute_routes = trip_count_df[(trip_count_df.loc[:, "count"] > min_threshold) &
-                                       (trip_count_df.loc[:, "return_count"] > min_threshold) &
-                                       (pd.DataFrame({1: (trip_count_df.loc[:, "count"] / trip_count_df.loc[:, "return_count"]),
-                                                      2: (trip_count_df.loc[:, "return_count"] / trip_count_df.loc[:, "count"])}
-                                                     ).min(axis=1) > ratio_threshold)].reset_index().loc[:, ["level_0", "level_1"]]
-
-        commute_routes.loc[:, "value"] = 1.0
+                                   (trip_df.start_date.dt.dayofweek < 5)]
+
+        # Count the number of relevant trips between stations in a sparse station x station matrix.
+        station_ids, station_indices = np.unique(np.concatenate([filtered_trip_df.start_station_id.values,
+                                                                 filtered_trip_df.end_station_id.values]),
+                                                 return_inverse=True)
+        start_indices, end_indices = np.split(station_indices, 2)
+        trip_counts = sparse.csr_matrix((np.ones(len(start_indices)), (start_indices, end_indices)),
+                                        shape=(len(station_ids), len(station_ids)))
+
+        # Return counts are the counts of the transposed pairs.
+        return_counts = trip_counts.T
+
+        # Keep the station pairs whose counts in both directions are over min_threshold
+        # and whose smaller count is over ratio_threshold of the larger one.
+        fewer_trips = trip_counts.minimum(return_counts)
+        more_trips = trip_counts.maximum(return_counts)
+        commutes = (fewer_trips > min_threshold).multiply((fewer_trips - ratio_threshold * more_trips) > 0).tocsr()
+        commutes.sort_indices()
+        commute_rows, commute_cols = commutes.nonzero()
+
+        commute_routes = pd.DataFrame({"level_0": station_ids[commute_rows],
+                                       "level_1": station_ids[commute_cols],
+                                       "value": 1.0})
         self.write(commute_routes, "Commute_obs", path)
 
     def demand_predicate(self, demand_df, path, partition, write_value=True):
@@ -121,9 +196,7 @@ class predicate_constructor:
         avg_demand_series = obs_demand_df.groupby('time').mean()
         predicted_demand_df = pd.DataFrame(index=original_target_demand_df.time.unique())
 
-        arima_model = SARIMAX(avg_demand_series.values, order=(0, 0, 0), seasonal_order=(1, 1, 1, 24))
-        fitted_arima_model = arima_model.fit(disp=False)
-        arima_predictions = np.clip(fitted_arima_model.forecast(steps=predicted_demand_df.shape[0]), 0, 1)
+        arima_predictions = np.clip(self.arima_forecast(avg_demand_series, predicted_demand_df.shape[0]), 0, 1)
         predicted_demand_df.loc[predicted_demand_df.index, 'ARIMA_predictions'] = arima_predictions
         predicted_demand_df = predicted_demand_df.reset_index()
         predicted_demand_df.columns = ['time', 'ARIMA_Predictions']
@@ -131,45 +204,124 @@ class predicate_constructor:
         self.write(predicted_demand_df.loc[:, ['time', 'ARIMA_Predictions']], 'ARIMA_obs', path)
         return predicted_demand_df.loc[:, ['time', 'ARIMA_Predictions']]
 
-    def station_to_zipcode_map(self, station_df, weather_df):
-        zipcode_list = weather_df["zip_code"].unique()
-        zipmodel = pgeocode.Nominatim('us')
-        zip_to_station = dict({})
-
-        for idx, row in station_df.iterrows():
-            zip_distances = []
+    def arima_forecast(self, avg_demand_series, steps):
+        """
+        Forecast average demand with an ARIMA model warm started from the model of the previous call.
+        When the series only extends the previous one, the new observations are filtered through the previous model
+        with its parameters, and the parameters are refit, starting from the previous ones, every arima_refit_interval updates.
+        Forecasts between refits are not checked against a refit, the drift is only reported at refits.
+        :param avg_demand_series: Average demand indexed by time, in time order.
+        :param steps: Number of time steps to forecast.
+        """
+        new_values = None
+        if (self.arima_results is not None and len(avg_demand_series) >= self.arima_observed_length
+                and avg_demand_series.index[self.arima_observed_length - 1] == self.arima_last_time):
+            new_values = avg_demand_series.values[self.arima_observed_length:]
+
+        if new_values is None:
+            # No previous model of this series, fit from scratch.
+            arima_model = SARIMAX(avg_demand_series.values, order=(0, 0, 0), seasonal_order=(1, 1, 1, 24))
+            self.arima_results = arima_model.fit(disp=False)
+            self.arima_updates = 0
+        elif len(new_values) > 0:
+            extended_results = self.arima_results.extend(new_values)
+            self.arima_updates += 1
+
+            if self.arima_updates < self.arima_refit_interval:
+                self.arima_results = extended_results
+            else:
+                arima_model = SARIMAX(avg_demand_series.values, order=(0, 0, 0), seasonal_order=(1, 1, 1, 24))
+                refit_results = arima_model.fit(start_params=self.arima_results.params, disp=False)
+                self.arima_updates = 0
+
+                # Report how far the warm started model drifted from the refit one.
+                deviation = np.max(np.abs(extended_results.forecast(steps=steps) - refit_results.forecast(steps=steps)))
+                if deviation > self.arima_drift_warning:
+                    warnings.warn("Warm started ARIMA forecast deviated from the refit forecast by {:.4f}.".format(deviation))
+
+                self.arima_results = refit_results
+
+        self.arima_last_time = avg_demand_series.index[-1]
+        self.arima_observed_length = len(avg_demand_series)
+
+        return self.arima_results.forecast(steps=steps)
+
+    def zipcode_geocodes(self, zipcode_list):
+        """
+        Look up the latitude and longitude of each zip code, indexed by zip code.
+        Geocodes found in the zip code cache are not queried again and new ones are added to it.
+        Zip codes that could not be geocoded are not cached, and raise a ValueError.
+        """
+        geocodes_df = pd.DataFrame(columns=['latitude', 'longitude'], index=pd.Index([], name='zip_code'))
+        if self.zipcode_cache_path is not None and os.path.exists(self.zipcode_cache_path):
+            geocodes_df = pd.read_csv(self.zipcode_cache_path, index_col='zip_code')
+
+        missing_zipcodes = pd.Index(zipcode_list).difference(geocodes_df.index)
+        if len(missing_zipcodes) > 0:
+            zipmodel = pgeocode.Nominatim('us')
+            zipcode_info = zipmodel.query_postal_code([str(zipcode) for zipcode in missing_zipcodes])
+            missing_geocodes_df = pd.DataFrame({'latitude': zipcode_info["latitude"].values,
+                                                'longitude': zipcode_info["longitude"].values},
+                                               index=pd.Index(missing_zipcodes, name='zip_code'))
+            missing_geocodes_df = missing_geocodes_df.dropna()
+            geocodes_df = pd.concat([geocodes_df, missing_geocodes_df])
+
+            if self.zipcode_cache_path is not None:
+                # Folds may be constructed in parallel, so replace the cache file in one step.
+                os.makedirs(os.path.dirname(os.path.abspath(self.zipcode_cache_path)), exist_ok=True)
+                temp_path = "{}.{}".format(self.zipcode_cache_path, os.getpid())
+                geocodes_df.to_csv(temp_path)
+                os.replace(temp_path, self.zipcode_cache_path)
+
+        unknown_zipcodes = pd.Index(zipcode_list).difference(geocodes_df.index)
+        if len(unknown_zipcodes) > 0:
+            raise ValueError("Could not geocode zip codes: %s" % (', '.join(str(zipcode) for zipcode in unknown_zipcodes)))
+
+        return geocodes_df.loc[zipcode_list]
 
-            for zipcode in zipcode_list:
-                zipcode_info = zipmodel.query_postal_code(str(zipcode))
-                zip_lat = zipcode_info["latitude"]
-                zip_lon = zipcode_info["longitude"]
+    def station_to_zipcode_map(self, station_df, weather_df):
+        # The stations and weather zip codes are the same for every time step of a fold.
+        if self.zip_to_station is not None:
+            return self.zip_to_station
 
-                zip_distances += [(zipcode, haversine_distances([[row["lat"], row["long"]]],
-                                                                [[zip_lat, zip_lon]])[0][0])]
+        zipcode_list = weather_df["zip_code"].unique()
+        geocodes_df = self.zipcode_geocodes(zipcode_list)
 
-            nearest_zip = sorted(zip_distances, key=lambda x: x[1])[0][0]
+        # Haversine distances expect (latitude, longitude) in radians.
+        zip_distances = haversine_distances(np.radians(station_df.loc[:, ['lat', 'long']].values.astype(float)),
+                                            np.radians(geocodes_df.loc[:, ['latitude', 'longitude']].values.astype(float)))
+        nearest_zips = zipcode_list[np.argmin(zip_distances, axis=1)]
 
+        zip_to_station = dict({})
+        for idx, nearest_zip in zip(station_df.index, nearest_zips):
             if nearest_zip not in zip_to_station.keys():
                 zip_to_station[nearest_zip] = [idx]
             else:
                 zip_to_station[nearest_zip] += [idx]
 
+        self.zip_to_station = zip_to_station
         return zip_to_station
 
     def raining_predicate(self, weather_df, station_df, demand_df, path):
-        raining_df = pd.DataFrame({'station_id': demand_df.station_id,
-                                   'time': demand_df.time,
-                                   'raining': 0})
-
         zip_to_station = self.station_to_zipcode_map(station_df, weather_df)
-        weather_events_df = weather_df[weather_df.events.notnull()]
+        station_to_zip = pd.Series({station_id: zipcode
+                                    for zipcode, station_ids in zip_to_station.items()
+                                    for station_id in station_ids})
+
+        # Days with a weather event in each zip code.
+        weather_events_df = weather_df.loc[weather_df.events.notnull(), ['zip_code', 'date']].drop_duplicates()
+        weather_events_df['raining'] = 1
 
-        for idx, row in weather_events_df.iterrows():
-            for station_id in zip_to_station[row["zip_code"]]:
-                raining_df[(raining_df.time.dt.floor("1440min") == row["date"])
-                           & (raining_df.station_id == station_id)].raining = 1
+        # Join each demand entry to the weather events of its station's zip code on that day.
+        raining_df = pd.DataFrame({'station_id': demand_df.station_id,
+                                   'time': demand_df.time,
+                                   'zip_code': demand_df.station_id.map(station_to_zip),
+                                   'date': demand_df.time.dt.floor("1440min")})
+        raining_df = raining_df.merge(weather_events_df, how='left', on=['zip_code', 'date'])
+        raining_df.index = demand_df.index
+        raining_df['raining'] = raining_df.raining.fillna(0).astype(int)
+        raining_df = raining_df.loc[:, ['station_id', 'time', 'raining']]
 
         self.write(raining_df, "Raining_obs", path)
 
         return raining_df
-
@@ -20,7 +20,7 @@ function main() {
     fetch_file "${DATA_URL}" "${DATA_DIR}/${DATA_FILE}"
     extract_zip "${DATA_DIR}/${DATA_FILE}" "${DATA_DIR}/${EXTRACTED_DATA_FILE}"
 
-    python3 ${DATA_CONSTRUCTION_SCRIPT} ${DATA_DIR}
+    python3 ${DATA_CONSTRUCTION_SCRIPT} ${DATA_DIR} "$@"
 }
 
 function check_requirements() {
@@ -2,10 +2,14 @@
 Construct PSL formatted data from raw movielens data.
 """
 
+import hashlib
 import pandas as pd
 import numpy as np
 import os
 import shutil
+import sys
+
+from multiprocessing import Pool
 
 import predicate_constructors
 
@@ -13,6 +17,9 @@ DIRNAME = os.path.dirname(__file__)
 BASE_DATA_PATH = os.path.join(DIRNAME, "../../data")
 RAW_RATINGS_PATH = os.path.join(BASE_DATA_PATH, "ml-1m/ratings.dat")
 RAW_MOVIES_PATH = os.path.join(BASE_DATA_PATH, "ml-1m/movies.dat")
+CACHE_PATH = os.path.join(BASE_DATA_PATH, "cache")
+# Version of the parsing done by each raw data loader, bump it when the loader changes to invalidate its cache.
+LOADER_VERSIONS = {"load_movies": 1, "load_ratings": 1}
 N_FOLDS = 10
 SAMPLE_PROPORTION = 0.7  # The sample proportion for each fold.
 INITIAL_PROPORTION = 1 / 3  # The proportion of the fold data that is initially observed.
@@ -31,10 +38,14 @@ OBS = 'obs'
 TARGET = 'target'
 TRUTH = 'truth'
 
+# Predicates that are the same for every time step of a fold.
+STATIC_PREDICATE_FILES = ["nmf_rating_obs.txt", "sim_content_items_obs.txt", "sim_items_obs.txt", "sim_users_obs.txt"]
+
 
-def construct_predicates():
+def construct_predicates(jobs=1):
     """
     Create data directory to write output to.
+    :param jobs: The number of processes that construct folds concurrently.
     """
     if not os.path.exists(BASE_DATA_PATH):
         os.makedirs(BASE_DATA_PATH)
@@ -44,49 +55,81 @@ def construct_predicates():
     """
     movies_df, ratings_df = load_dataframes()
     movies_df, ratings_df = filter_dataframes(movies_df, ratings_df)
-    ratings_df_list = sample_randomly(ratings_df)
 
-    for fold, fold_ratings_df in enumerate(ratings_df_list):
-        print("Constructing fold #" + str(fold).zfill(2))
+    if jobs <= 1:
+        for fold in range(N_FOLDS):
+            construct_fold(fold, movies_df, ratings_df)
+    else:
+        # The input frames are sent to each worker once rather than with every fold.
+        with Pool(jobs, initializer=_init_fold_worker, initargs=(movies_df, ratings_df)) as pool:
+            pool.map(_construct_fold_worker, range(N_FOLDS))
+
+
+def construct_fold(fold, movies_df, ratings_df):
+    """
+    Construct the time series and online data of one fold.
+    Folds are independent, so they can be constructed in any order or concurrently.
+    """
+    print("Constructing fold #" + str(fold).zfill(2))
+
+    # Seed the random state with the fold so the output does not depend on the order folds are constructed in.
+    np.random.seed(fold)
+    fold_ratings_df = sample_fold(ratings_df, fold)
 
-        time_series_out_directory = os.path.join(BASE_DATA_PATH, 'movielens-1m/movielens-1m_time_series/' + str(fold).zfill(2) + '/eval/')
-        print("Making " + time_series_out_directory)
-        if not os.path.exists(time_series_out_directory):
-            os.makedirs(time_series_out_directory)
+    time_series_out_directory = os.path.join(BASE_DATA_PATH, 'movielens-1m/movielens-1m_time_series/' + str(fold).zfill(2) + '/eval/')
+    print("Making " + time_series_out_directory)
+    os.makedirs(time_series_out_directory, exist_ok=True)
 
-        online_out_directory = os.path.join(BASE_DATA_PATH, 'movielens-1m/movielens-1m_online/' + str(fold).zfill(2) + '/eval/')
-        print("Making " + online_out_directory)
-        if not os.path.exists(online_out_directory):
-            os.makedirs(online_out_directory)
+    online_out_directory = os.path.join(BASE_DATA_PATH, 'movielens-1m/movielens-1m_online/' + str(fold).zfill(2) + '/eval/')
+    print("Making " + online_out_directory)
+    os.makedirs(online_out_directory, exist_ok=True)
 
-        # Sort ratings frame by timestep.
-        fold_ratings_df = fold_ratings_df.sort_values(by='timestamp')
+    # Sort ratings frame by timestep.
+    fold_ratings_df = fold_ratings_df.sort_values(by='timestamp')
 
-        # Grab movies in movie df for fold.
-        fold_movies_df = movies_df.loc[fold_ratings_df.index.get_level_values('movieId').unique()]
+    # Grab movies in movie df for fold.
+    fold_movies_df = movies_df.loc[fold_ratings_df.index.get_level_values('movieId').unique()]
 
-        # Grab unique users and movies in ratings df for fold.
-        fold_unique_users = fold_ratings_df.index.get_level_values('userId').unique()
-        fold_unique_movies = fold_ratings_df.index.get_level_values('movieId').unique()
+    # Grab unique users and movies in ratings df for fold.
+    fold_unique_users = fold_ratings_df.index.get_level_values('userId').unique()
+    fold_unique_movies = fold_ratings_df.index.get_level_values('movieId').unique()
 
-        # Get the observations/truth split for this fold.
-        observed_ratings_df = fold_ratings_df.iloc[: int(fold_ratings_df.shape[0] * INITIAL_PROPORTION)]
-        truth_ratings_df = fold_ratings_df.iloc[int(fold_ratings_df.shape[0] * INITIAL_PROPORTION):]
-        partitioned_truth_ratings = partition(truth_ratings_df)
+    # Get the observations/truth split for this fold.
+    observed_ratings_df = fold_ratings_df.iloc[: int(fold_ratings_df.shape[0] * INITIAL_PROPORTION)]
+    truth_ratings_df = fold_ratings_df.iloc[int(fold_ratings_df.shape[0] * INITIAL_PROPORTION):]
+    partitioned_truth_ratings = partition(truth_ratings_df)
 
-        # Construct predicates that are static for this fold.
-        # print("Constructing static predicates.")
-        construct_static_predicates(observed_ratings_df, truth_ratings_df, fold_movies_df,
-                                    time_series_out_directory, online_out_directory)
+    # Construct predicates that are static for this fold.
+    # print("Constructing static predicates.")
+    construct_static_predicates(observed_ratings_df, truth_ratings_df, fold_movies_df,
+                                time_series_out_directory, online_out_directory)
 
-        # Construct predicates that are dynamic with time.
-        print("Constructing dynamic predicates.")
-        construct_dynamic_predicates(observed_ratings_df, partitioned_truth_ratings,
-                                     fold_unique_users, fold_unique_movies,
-                                     time_series_out_directory, online_out_directory)
+    # Construct predicates that are dynamic with time.
+    print("Constructing dynamic predicates.")
+    construct_dynamic_predicates(observed_ratings_df, partitioned_truth_ratings,
+                                 fold_unique_users, fold_unique_movies,
+                                 time_series_out_directory, online_out_directory)
 
 
-def construct_client_commands(prev_observed_ratings, observed_ratings, prev_truth_ratings, current_truth_ratings, time_step):
+def _init_fold_worker(movies_df, ratings_df):
+    global _worker_dataframes
+    _worker_dataframes = (movies_df, ratings_df)
+
+
+def _construct_fold_worker(fold):
+    construct_fold(fold, *_worker_dataframes)
+
+
+def construct_client_commands(new_observed_ratings, new_truth_ratings, removed_truth_ratings,
+                              changed_user_averages, changed_item_averages, time_step):
+    """
+    Construct the client commands for a time step from the changes made to the observations and targets.
+    :param new_observed_ratings: The ratings that are observed starting at this time step.
+    :param new_truth_ratings: The ratings that are targets starting at this time step.
+    :param removed_truth_ratings: The ratings that are no longer targets starting at this time step.
+    :param changed_user_averages: The series of user average ratings that changed at this time step.
+    :param changed_item_averages: The series of item average ratings that changed at this time step.
+    """
     add_targets_command_list = []
     update_target_command_list = []
     add_observation_command_list = []
@@ -96,19 +139,19 @@ def construct_client_commands(prev_observed_ratings, observed_ratings, prev_trut
 
     if time_step > 0:
         # Observe and add ratings atoms.
-        new_targets_df = current_truth_ratings.loc[current_truth_ratings.index.difference(prev_truth_ratings.index)].reset_index()
+        new_targets_df = new_truth_ratings.reset_index()
         add_targets_command_list += df_to_command(new_targets_df.loc[:, ['userId', 'movieId']],
                                                   new_targets_df.loc[:, []],
                                                   ADD, TARGET, 'rating')
 
-        observed_ratings_df = observed_ratings.loc[observed_ratings.index.difference(prev_observed_ratings.index)].reset_index()
+        observed_ratings_df = new_observed_ratings.reset_index()
         observe_command_list += df_to_command(
             observed_ratings_df.loc[:, ['userId', 'movieId']],
             observed_ratings_df.loc[:, ['rating']],
             OBSERVE, OBS, 'rating')
 
         # Add rated atoms (Assumed that new rated predicates are introduced only through truths).
-        new_rated_df = current_truth_ratings.loc[current_truth_ratings.index.difference(prev_truth_ratings.index)].reset_index()
+        new_rated_df = new_targets_df
         add_observation_command_list += df_to_command(
             new_rated_df.loc[:, ['userId', 'movieId']],
             new_rated_df.loc[:, ['rating']].clip(1, 1),
@@ -120,21 +163,21 @@ def construct_client_commands(prev_observed_ratings, observed_ratings, prev_trut
             new_rated_df.loc[:, ['rating']].clip(1, 1),
             ADD, OBS, 'target')
 
-        observed_targets = prev_truth_ratings.loc[prev_truth_ratings.index.difference(current_truth_ratings.index)].reset_index()
+        observed_targets = removed_truth_ratings.reset_index()
         update_target_command_list += df_to_command(
             observed_targets.loc[:, ['userId', 'movieId']],
             observed_targets.loc[:, ['rating']].clip(0, 0),
             UPDATE, OBS, 'target')
 
-        # Update averages.
-        seen_user_avg = observed_ratings['rating'].reset_index()[["userId", "rating"]].groupby("userId").mean().reset_index()
+        # Update averages that changed.
+        seen_user_avg = changed_user_averages.rename_axis('userId').reset_index()
         update_observation_command_list += df_to_command(
             seen_user_avg.loc[:, ['userId']],
             seen_user_avg.loc[:, ['rating']],
             UPDATE, OBS, 'avg_user_rating'
         )
 
-        seen_movie_avg = observed_ratings.swaplevel()['rating'].reset_index()[["movieId", "rating"]].groupby("movieId").mean().reset_index()
+        seen_movie_avg = changed_item_averages.rename_axis('movieId').reset_index()
         update_observation_command_list += df_to_command(
             seen_movie_avg.loc[:, ['movieId']],
             seen_movie_avg.loc[:, ['rating']],
@@ -150,11 +193,31 @@ def construct_client_commands(prev_observed_ratings, observed_ratings, prev_trut
 
 def construct_dynamic_predicates(observed_ratings_df, partitioned_truth_ratings, fold_unique_users, fold_unique_movies,
                                  time_series_out_directory, online_out_directory):
-    # Start initial observations.
-    # These dataframes will grow with each timestep by adding some or all of the previous timestep's target set.
-    online_aggregated_observed_ratings = observed_ratings_df
-    time_series_aggregated_observed_ratings = observed_ratings_df
-    time_series_aggregated_truth_ratings = partitioned_truth_ratings[0]
+    # The partitions are consecutive blocks of rows of the truth ratings.
+    # Every observed and target set is kept as a slice or a row mask of these ratings
+    # and each partition is applied to them as a change rather than rebuilding the sets at every time step.
+    truth_ratings_df = pd.concat(partitioned_truth_ratings)
+    partition_offsets = np.cumsum([0] + [partition_df.shape[0] for partition_df in partitioned_truth_ratings])
+
+    # Online observations are the initial observations and the partitions before the time step,
+    # online targets are the partitions from the time step on.
+    online_ratings_df = pd.concat([observed_ratings_df, truth_ratings_df])
+
+    # Time series observations are the initial observations and a sample of each previous partition,
+    # time series targets are the unsampled rows of the partitions up to and including the time step.
+    time_series_observed_mask = np.zeros(truth_ratings_df.shape[0], dtype=bool)
+    time_series_truth_mask = np.zeros(truth_ratings_df.shape[0], dtype=bool)
+    time_series_truth_mask[partition_offsets[0]:partition_offsets[1]] = True
+
+    # Average ratings are kept as running rating sums and counts that are updated with each time step's observations.
+    online_user_rating_totals = predicate_constructors.rating_totals(fold_unique_users)
+    online_item_rating_totals = predicate_constructors.rating_totals(fold_unique_movies)
+    time_series_user_rating_totals = predicate_constructors.rating_totals(fold_unique_users)
+    time_series_item_rating_totals = predicate_constructors.rating_totals(fold_unique_movies)
+    for user_rating_totals, item_rating_totals in [(online_user_rating_totals, online_item_rating_totals),
+                                                   (time_series_user_rating_totals, time_series_item_rating_totals)]:
+        predicate_constructors.update_rating_totals(user_rating_totals, observed_ratings_df, 'userId')
+        predicate_constructors.update_rating_totals(item_rating_totals, observed_ratings_df, 'movieId')
 
     # Initialize empty list of commands.
     time_series_command_list = []
@@ -173,28 +236,53 @@ def construct_dynamic_predicates(observed_ratings_df, partitioned_truth_ratings,
         if not os.path.exists(online_path):
             os.makedirs(online_path)
 
-        # Update rating observations.
-        online_prev_observed_ratings = online_aggregated_observed_ratings.copy()
-        time_series_prev_observed_ratings = time_series_aggregated_observed_ratings.copy()
-        time_series_prev_truth_ratings = time_series_aggregated_truth_ratings.copy()
+        # Apply this time step's partitions to the observations and targets.
+        online_new_observed_ratings = truth_ratings_df.iloc[:0]
+        time_series_new_observed_ratings = truth_ratings_df.iloc[:0]
+        time_series_new_truth_ratings = truth_ratings_df.iloc[:0]
         if time_step > 0:
-            online_aggregated_observed_ratings = online_aggregated_observed_ratings.append(partitioned_truth_ratings[time_step - 1],
-                                                                                           ignore_index=False)
-            time_series_aggregated_truth_ratings = time_series_aggregated_truth_ratings.append(partitioned_truth_ratings[time_step],
-                                                                                               ignore_index=False)
-
-            time_series_observations = partitioned_truth_ratings[time_step - 1].sample(frac=TIMESERIES_PROPORTION_OBS)
-            time_series_aggregated_observed_ratings = time_series_aggregated_observed_ratings.append(time_series_observations,
-                                                                                                     ignore_index=False)
-            time_series_aggregated_truth_ratings = time_series_aggregated_truth_ratings.drop(time_series_observations.index)
+            online_new_observed_ratings = partitioned_truth_ratings[time_step - 1]
+
+            previous_partition_positions = np.arange(partition_offsets[time_step - 1], partition_offsets[time_step])
+            time_series_observed_positions = pd.Series(previous_partition_positions).sample(
+                frac=TIMESERIES_PROPORTION_OBS).values
+            time_series_observed_mask[time_series_observed_positions] = True
+            time_series_truth_mask[time_series_observed_positions] = False
+            time_series_truth_mask[partition_offsets[time_step]:partition_offsets[time_step + 1]] = True
+
+            time_series_new_observed_ratings = truth_ratings_df.iloc[time_series_observed_positions]
+            time_series_new_truth_ratings = partitioned_truth_ratings[time_step]
+
+        online_aggregated_observed_ratings = online_ratings_df.iloc[:observed_ratings_df.shape[0] + partition_offsets[time_step]]
+        online_truth_ratings = truth_ratings_df.iloc[partition_offsets[time_step]:]
+        time_series_aggregated_observed_ratings = pd.concat([observed_ratings_df,
+                                                             truth_ratings_df.iloc[time_series_observed_mask]])
+        time_series_aggregated_truth_ratings = truth_ratings_df.iloc[time_series_truth_mask]
+
+        # Update the running average ratings with the new observations.
+        online_changed_user_averages = predicate_constructors.update_rating_totals(
+            online_user_rating_totals, online_new_observed_ratings, 'userId')
+        online_changed_item_averages = predicate_constructors.update_rating_totals(
+            online_item_rating_totals, online_new_observed_ratings, 'movieId')
+        time_series_changed_user_averages = predicate_constructors.update_rating_totals(
+            time_series_user_rating_totals, time_series_new_observed_ratings, 'userId')
+        time_series_changed_item_averages = predicate_constructors.update_rating_totals(
+            time_series_item_rating_totals, time_series_new_observed_ratings, 'movieId')
 
         # Get client commands for this timestep.
-        online_command_list += construct_client_commands(online_prev_observed_ratings, online_aggregated_observed_ratings,
-                                                         pd.concat(partitioned_truth_ratings[time_step-1:]),
-                                                         pd.concat(partitioned_truth_ratings[time_step:]),
+        # Online targets only shrink, the observed partition stops being a target.
+        online_command_list += construct_client_commands(online_new_observed_ratings,
+                                                         truth_ratings_df.iloc[:0],
+                                                         online_new_observed_ratings,
+                                                         online_changed_user_averages,
+                                                         online_changed_item_averages,
                                                          time_step)
-        time_series_command_list += construct_client_commands(time_series_prev_observed_ratings, time_series_aggregated_observed_ratings,
-                                                              time_series_prev_truth_ratings, time_series_aggregated_truth_ratings,
+        # Time series targets grow by the new partition, the sampled observations stop being targets.
+        time_series_command_list += construct_client_commands(time_series_new_observed_ratings,
+                                                              time_series_new_truth_ratings,
+                                                              time_series_new_observed_ratings,
+                                                              time_series_changed_user_averages,
+                                                              time_series_changed_item_averages,
                                                               time_step)
 
         # Construct and write the predicates for timestamp.
@@ -206,15 +294,15 @@ def construct_dynamic_predicates(observed_ratings_df, partitioned_truth_ratings,
                                                  time_series_path, TRUTH)
 
         predicate_constructors.ratings_predicate(online_aggregated_observed_ratings, online_path, OBS)
-        predicate_constructors.ratings_predicate(pd.concat(partitioned_truth_ratings[time_step:]),
+        predicate_constructors.ratings_predicate(online_truth_ratings,
                                                  online_path, TARGET, write_value=False)
-        predicate_constructors.ratings_predicate(pd.concat(partitioned_truth_ratings[time_step:]),
+        predicate_constructors.ratings_predicate(online_truth_ratings,
                                                  online_path, TRUTH)
 
         # Target predicate.
         predicate_constructors.target_predicate(time_series_aggregated_truth_ratings, time_series_path, OBS)
 
-        predicate_constructors.target_predicate(pd.concat(partitioned_truth_ratings[time_step:]),
+        predicate_constructors.target_predicate(online_truth_ratings,
                                                 online_path, OBS)
 
         # Rated predicate.
@@ -223,19 +311,19 @@ def construct_dynamic_predicates(observed_ratings_df, partitioned_truth_ratings,
                                                time_series_path, OBS)
 
         predicate_constructors.rated_predicate(online_aggregated_observed_ratings,
-                                               pd.concat(partitioned_truth_ratings[time_step:]),
+                                               online_truth_ratings,
                                                online_path, OBS)
 
         # Avg predicates.
-        predicate_constructors.average_item_rating_predicate(time_series_aggregated_observed_ratings, time_series_path,
-                                                             fold_unique_movies, fill_na=True)
-        predicate_constructors.average_item_rating_predicate(online_aggregated_observed_ratings, online_path,
-                                                             fold_unique_movies, fill_na=True)
+        predicate_constructors.average_item_rating_predicate(time_series_item_rating_totals, time_series_path,
+                                                             fill_na=True)
+        predicate_constructors.average_item_rating_predicate(online_item_rating_totals, online_path,
+                                                             fill_na=True)
 
-        predicate_constructors.average_user_rating_predicate(time_series_aggregated_observed_ratings, time_series_path,
-                                                             fold_unique_users, fill_na=True)
-        predicate_constructors.average_user_rating_predicate(online_aggregated_observed_ratings, online_path,
-                                                             fold_unique_users, fill_na=True)
+        predicate_constructors.average_user_rating_predicate(time_series_user_rating_totals, time_series_path,
+                                                             fill_na=True)
+        predicate_constructors.average_user_rating_predicate(online_user_rating_totals, online_path,
+                                                             fill_na=True)
 
     # Finally write commands file.
     time_series_command_list += ["STOP"]
@@ -261,20 +349,14 @@ def construct_static_predicates(observed_ratings_df, truth_ratings_df, movies_df
     # Construct static predicates and save to time series path.
     predicate_constructors.nmf_ratings_predicate(observed_ratings_df, truth_ratings_df, time_series_path)
     predicate_constructors.sim_content_predicate(movies_df, time_series_path)
-    predicate_constructors.sim_items_predicate(observed_ratings_df, time_series_path)
-    predicate_constructors.sim_users_predicate(observed_ratings_df, time_series_path)
-
-    # Construct static predicates copy static predicates to the online path.
-    shutil.copy(os.path.join(time_series_path, "nmf_rating_obs.txt"),
-                os.path.join(online_path, "nmf_rating_obs.txt"))
-    shutil.copy(os.path.join(time_series_path, "sim_content_items_obs.txt"),
-                os.path.join(online_path, "sim_content_items_obs.txt"))
-    shutil.copy(os.path.join(time_series_path, "sim_items_obs.txt"),
-                os.path.join(online_path, "sim_items_obs.txt"))
-    shutil.copy(os.path.join(time_series_path, "sim_users_obs.txt"),
-                os.path.join(online_path, "sim_users_obs.txt"))
-
-    # Duplicate 0'th time step data for offline run on time steps > 0.
+
+    # The user and item similarities share one sparse ratings matrix.
+    ratings_matrix, users, movies = predicate_constructors.sparse_ratings_matrix(observed_ratings_df)
+    predicate_constructors.sim_items_predicate(ratings_matrix, movies, time_series_path)
+    predicate_constructors.sim_users_predicate(ratings_matrix, users, time_series_path)
+
+    # Link the static predicates written once to the online path and to every other time step.
+    link_paths = [online_path]
     for i in range(NUM_PARTITIONS - 1):
         # Set the shared path between these predicates.
         cp_time_series_path = os.path.join(time_series_out_directory, str(i + 1).zfill(2))
@@ -285,78 +367,82 @@ def construct_static_predicates(observed_ratings_df, truth_ratings_df, movies_df
         if not os.path.exists(cp_online_path):
             os.makedirs(cp_online_path)
 
-        shutil.copy(os.path.join(time_series_path, "nmf_rating_obs.txt"),
-                    os.path.join(cp_time_series_path, "nmf_rating_obs.txt"))
-        shutil.copy(os.path.join(time_series_path, "nmf_rating_obs.txt"),
-                    os.path.join(cp_online_path, "nmf_rating_obs.txt"))
-        shutil.copy(os.path.join(time_series_path, "sim_content_items_obs.txt"),
-                    os.path.join(cp_time_series_path, "sim_content_items_obs.txt"))
-        shutil.copy(os.path.join(time_series_path, "sim_content_items_obs.txt"),
-                    os.path.join(cp_online_path, "sim_content_items_obs.txt"))
-        shutil.copy(os.path.join(time_series_path, "sim_items_obs.txt"),
-                    os.path.join(cp_time_series_path, "sim_items_obs.txt"))
-        shutil.copy(os.path.join(time_series_path, "sim_items_obs.txt"),
-                    os.path.join(cp_online_path, "sim_items_obs.txt"))
-        shutil.copy(os.path.join(time_series_path, "sim_users_obs.txt"),
-                    os.path.join(cp_time_series_path, "sim_users_obs.txt"))
-        shutil.copy(os.path.join(time_series_path, "sim_users_obs.txt"),
-                    os.path.join(cp_online_path, "sim_users_obs.txt"))
+        link_paths += [cp_time_series_path, cp_online_path]
+
+    for link_path in link_paths:
+        link_static_predicates(time_series_path, link_path, STATIC_PREDICATE_FILES)
+
+
+def link_static_predicates(source_path, destination_path, file_names):
+    """
+    Share static predicate files between directories.
+    Files are hard linked so the data is stored once, and copied if the file system does not support hard links.
+    """
+    for file_name in file_names:
+        source_file = os.path.join(source_path, file_name)
+        destination_file = os.path.join(destination_path, file_name)
+
+        if os.path.exists(destination_file):
+            os.remove(destination_file)
+
+        try:
+            os.link(source_file, destination_file)
+        except OSError:
+            shutil.copy(source_file, destination_file)
 
 
 def df_to_command(constants_df, value_series, action_type, partition_name, predicate_name):
-    command_list = []
     assert(constants_df.shape[0] == value_series.shape[0])
 
-    for idx, row in constants_df.iterrows():
-        predicate_constants = row.values
-        if value_series.loc[idx].shape[0] != 0:
-            value = value_series.loc[idx].values[0]
-        else:
-            value = None
-        command_list += [create_command_line(action_type, partition_name, predicate_name, predicate_constants, value)]
-    return command_list
+    # Quote and join the predicate constants one column at a time.
+    constants = pd.Series("", index=np.arange(constants_df.shape[0]), dtype=object)
+    for column_number in range(constants_df.shape[1]):
+        if column_number > 0:
+            constants = constants + ","
+        constants = constants + "'" + constants_df.iloc[:, column_number].astype(str).values + "'"
 
+    if value_series.shape[1] != 0:
+        values = pd.Series(value_series.iloc[:, 0].astype(str).values, index=constants.index)
+    else:
+        values = None
 
-def create_command_line(action_type, partition_name, predicate_name, predicate_constants, value):
+    return create_command_lines(action_type, partition_name, predicate_name, constants, values).tolist()
+
+
+def create_command_lines(action_type, partition_name, predicate_name, constants, values):
     if partition_name == OBS:
         partition_str = "READ"
     elif partition_name == TARGET:
         partition_str = "WRITE"
 
-    quoted_predicate_constants = ["'" + str(const) + "'" for const in predicate_constants]
-    constants_list = ",".join(quoted_predicate_constants)
-
-
     if action_type == ADD:
-        if value is not None:
-            return ADD + "\t" + partition_str + "\t" + predicate_name + "(" + constants_list + ")\t" + str(value)
+        if values is not None:
+            return ADD + "\t" + partition_str + "\t" + predicate_name + "(" + constants + ")\t" + values
         else:
-            return ADD + "\t" + partition_str + "\t" + predicate_name + "(" + constants_list + ")"
+            return ADD + "\t" + partition_str + "\t" + predicate_name + "(" + constants + ")"
 
     if action_type == OBSERVE:
-        return OBSERVE + "\t" + predicate_name + "\t(" + constants_list + ")\t" + str(value)
+        return OBSERVE + "\t" + predicate_name + "\t(" + constants + ")\t" + values
 
     elif action_type == UPDATE:
-        return UPDATE + "\t" + predicate_name + "(" + constants_list + ")\t" + str(value)
+        return UPDATE + "\t" + predicate_name + "(" + constants + ")\t" + values
 
     elif action_type == DELETE:
-        return DELETE + "\t" + partition_str + "\t" + predicate_name + "(" + constants_list + ")"
+        return DELETE + "\t" + partition_str + "\t" + predicate_name + "(" + constants + ")"
 
 
-def command_file_write(command_list, path):
-    command_str = ''
-    for command in command_list:
-        command_str += command + '\n'
-
+def command_file_write(command_list, path, chunk_size=100000):
     if not os.path.exists(path):
         os.makedirs(path)
 
+    # Write the commands in chunks rather than building the whole file in memory.
     with open(os.path.join(path, 'commands.txt'), 'w') as writer:
-        writer.write(command_str)
+        for start in range(0, len(command_list), chunk_size):
+            writer.write('\n'.join(command_list[start:start + chunk_size]) + '\n')
 
 
-def sample_randomly(ratings_df, n_folds=N_FOLDS, sample_proportion=SAMPLE_PROPORTION):
-    return [ratings_df.sample(frac=sample_proportion, random_state=i) for i in np.arange(n_folds)]
+def sample_fold(ratings_df, fold, sample_proportion=SAMPLE_PROPORTION):
+    return ratings_df.sample(frac=sample_proportion, random_state=fold)
 
 
 def partition(ratings_df, n_partitions=NUM_PARTITIONS):
@@ -384,24 +470,81 @@ def load_dataframes():
     """
     Assuming that the raw data already exists in the data directory
     """
-    movies_df = pd.read_csv(RAW_MOVIES_PATH, sep='::', header=None, encoding="ISO-8859-1", engine='python', skiprows=[0])
+    movies_df = cached_load(RAW_MOVIES_PATH, load_movies)
+    ratings_df = cached_load(RAW_RATINGS_PATH, load_ratings)
+
+    return movies_df, ratings_df
+
+
+def load_movies(path):
+    movies_df = pd.read_csv(path, sep='::', header=None, encoding="ISO-8859-1", engine='python', skiprows=[0])
     movies_df.columns = ["movieId", "movie title", "genres"]
     movies_df = movies_df.join(movies_df["genres"].str.get_dummies('|')).drop('genres', axis=1)
     movies_df = movies_df.astype({'movieId': int})
     movies_df = movies_df.set_index('movieId')
 
-    ratings_df = pd.read_csv(RAW_RATINGS_PATH, sep='::', header=None, engine='python', skiprows=[0])
+    return movies_df
+
+
+def load_ratings(path):
+    # Ratings fields only hold numbers, so the '::' separator can be read as two ':' with the faster c engine.
+    ratings_df = pd.read_csv(path, sep=':', header=None, usecols=[0, 2, 4, 6], skiprows=[0])
     ratings_df.columns = ['userId', 'movieId', 'rating', 'timestamp']
     ratings_df = ratings_df.astype({'userId': int, 'movieId': int})
     ratings_df.rating = ratings_df.rating / ratings_df.rating.max()
     ratings_df = ratings_df.set_index(['userId', 'movieId'])
 
-    return movies_df, ratings_df
+    return ratings_df
+
+
+def cached_load(raw_path, load_function):
+    """
+    Load a raw input file through a binary cache of its parsed frame.
+    The cache is keyed by a hash of the raw file and the loader's name and version,
+    so a changed raw file or loader is parsed again.
+    Pickled frames keep their dtypes and indexes and load without any parsing.
+    """
+    cache_file = os.path.join(CACHE_PATH, "{}.{}.v{}.{}.pkl".format(os.path.basename(raw_path), load_function.__name__,
+                                                                    LOADER_VERSIONS[load_function.__name__],
+                                                                    file_hash(raw_path)))
+    if os.path.exists(cache_file):
+        return pd.read_pickle(cache_file)
+
+    data = load_function(raw_path)
+
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    data.to_pickle(cache_file)
+    return data
+
+
+def file_hash(path, chunk_size=2 ** 20):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def main(jobs):
+    construct_predicates(jobs=jobs)
+
+
+def _load_args(args):
+    executable = args.pop(0)
+    jobs = 1
+
+    # Other arguments, like the data directory passed by construct.sh, are ignored.
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg.lower().strip().replace('-', '') in {'h', 'help'}:
+            print("USAGE: python3 %s [--jobs <number of processes>]" % (executable), file=sys.stderr)
+            sys.exit(1)
 
+        if arg in {'-j', '--jobs'}:
+            jobs = int(args.pop(0))
 
-def main():
-    construct_predicates()
+    return jobs
 
 
 if __name__ == '__main__':
-    main()
+    main(_load_args(sys.argv))
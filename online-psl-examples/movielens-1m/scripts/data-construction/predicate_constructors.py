@@ -6,6 +6,7 @@ import numpy as np
 import os
 import pandas as pd
 
+from scipy import sparse
 from sklearn.naive_bayes import MultinomialNB
 from surprise.prediction_algorithms.matrix_factorization import NMF
 from surprise.reader import Reader
@@ -24,48 +25,105 @@ def write(data, predicate_name, path):
     data.to_csv(os.path.join(path, predicate_name + '.txt'), sep='\t', header=False, index=True)
 
 
-def top_n_cosine_sim(matrix, index, n):
-    row_norms = [np.linalg.norm(row) for row in matrix]
-    normalized_matrix = np.array([matrix[i] / row_norms[i] for i in range(len(matrix))])
-    similarity_frame_data = np.matmul(normalized_matrix, normalized_matrix.T)
-    similarity_df = pd.DataFrame(data=similarity_frame_data,
-                                 index=index, columns=index)
+def top_n_cosine_sim(matrix, index, n, block_size=1024):
+    """
+    Find the n most cosine similar rows for every row of a matrix.
+    Similarities are computed one block of rows at a time so the full row x row similarity matrix is never built.
+    :param matrix: The 2-d numpy array or scipy sparse matrix whose rows are compared.
+    :param index: The labels of the rows of the matrix.
+    :param n: The number of most similar rows to keep for each row.
+    :param block_size: The number of rows whose similarities are computed at once.
+    :return: A series of the similarities clipped to [0, 1], indexed by (row label, similar row label) pairs.
+    """
+    index = np.asarray(index)
+    n = min(n, matrix.shape[0])
+
+    # Normalize rows. Rows with no entries have no similarity to any other row.
+    if sparse.issparse(matrix):
+        matrix = sparse.csr_matrix(matrix, dtype=float)
+        row_norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        row_norms[row_norms == 0] = 1.0
+        normalized_matrix = sparse.diags(1.0 / row_norms) @ matrix
+    else:
+        matrix = np.asarray(matrix, dtype=float)
+        row_norms = np.linalg.norm(matrix, axis=1)
+        row_norms[row_norms == 0] = 1.0
+        normalized_matrix = matrix / row_norms[:, np.newaxis]
+
+    top_n_columns = np.empty((matrix.shape[0], n), dtype=int)
+    top_n_similarities = np.empty((matrix.shape[0], n), dtype=float)
+    for start in range(0, matrix.shape[0], block_size):
+        end = min(start + block_size, matrix.shape[0])
+        block_similarities = normalized_matrix[start:end] @ normalized_matrix.T
+        if sparse.issparse(block_similarities):
+            block_similarities = block_similarities.toarray()
+
+        # Select the top n of each row, then order them by decreasing similarity.
+        block_columns = np.argpartition(-block_similarities, n - 1, axis=1)[:, :n]
+        block_top_n = np.take_along_axis(block_similarities, block_columns, axis=1)
+        order = np.argsort(-block_top_n, axis=1, kind='stable')
+        top_n_columns[start:end] = np.take_along_axis(block_columns, order, axis=1)
+        top_n_similarities[start:end] = np.take_along_axis(block_top_n, order, axis=1)
+
+    sim_index = pd.MultiIndex.from_arrays([np.repeat(index, n), index[top_n_columns.ravel()]])
+    return pd.Series(data=np.clip(top_n_similarities.ravel(), 0.0, 1.0), index=sim_index)
+
+
+def average_item_rating_predicate(item_rating_totals, path, fill_na=True):
+    """
+    Average item rating predicates.
+    :param item_rating_totals: The running rating totals of the items, see rating_totals.
+    """
+    write(rating_averages(item_rating_totals, fill_na=fill_na), 'avg_item_rating_obs', path)
 
-    # take top n for each movie to define pairwise blocks
-    top_n_similarity_frame = pd.DataFrame(index=index, columns=range(n))
-    for m in index:
-        top_n_similarity_frame.loc[m, :] = similarity_df.loc[m].nlargest(n).index
 
-    flattened_frame = top_n_similarity_frame.values.flatten()
-    sim_index = np.array([[i] * 50 for i in index]).flatten()
-    sim_index = pd.MultiIndex.from_arrays([sim_index, flattened_frame])
-    similarity_series = pd.Series(data=1, index=sim_index)
+def average_user_rating_predicate(user_rating_totals, path, fill_na=True):
+    """
+    Average user rating predicates.
+    :param user_rating_totals: The running rating totals of the users, see rating_totals.
+    """
+    write(rating_averages(user_rating_totals, fill_na=fill_na), 'avg_user_rating_obs', path)
 
-    # populate the item_content_similarity_series with the similarity value
-    for i in sim_index:
-        similarity_series.loc[i] = np.clip(similarity_df.loc[i[0], i[1]], 0.0, 1.0)
 
-    return similarity_series
+def rating_totals(ids):
+    """
+    Start running rating sums and counts for a set of users or items.
+    :param ids: The user or item ids the totals are kept for.
+    :return: A frame of zero rating sums and counts indexed by the ids.
+    """
+    return pd.DataFrame(data={'sum': 0.0, 'count': 0}, index=ids)
 
 
-def average_item_rating_predicate(observed_ratings_df, path, unique_movies, fill_na=True):
+def update_rating_totals(totals, ratings_df, level):
     """
-    Average item rating predicates.
+    Add newly observed ratings to running rating totals.
+    :param totals: The running rating totals from rating_totals. These are updated in place.
+    :param ratings_df: The newly observed ratings frame indexed by (userId, movieId).
+    :param level: The index level the totals are kept for, either 'userId' or 'movieId'.
+    :return: A series of the new average ratings of the ids whose average changed.
     """
-    avg_rating_series = observed_ratings_df.loc[:, 'rating'].reset_index()[["movieId", "rating"]].groupby("movieId").mean()
-    if fill_na:
-        avg_rating_series = avg_rating_series.reindex(unique_movies, fill_value=avg_rating_series.mean()['rating'])
-    write(avg_rating_series, 'avg_item_rating_obs', path)
+    new_totals = ratings_df.rating.groupby(level=level).agg(['sum', 'count'])
+    previous_averages = rating_averages(totals.loc[new_totals.index], fill_na=False)
+
+    totals.loc[new_totals.index, 'sum'] += new_totals['sum']
+    totals.loc[new_totals.index, 'count'] += new_totals['count']
 
+    averages = rating_averages(totals.loc[new_totals.index], fill_na=False)
+    return averages[averages.ne(previous_averages.reindex(averages.index))]
 
-def average_user_rating_predicate(observed_ratings_df, path, unique_users, fill_na=True):
+
+def rating_averages(totals, fill_na=True):
     """
-    Average user rating predicates.
+    Average ratings from running rating totals.
+    :param totals: The running rating totals from rating_totals.
+    :param fill_na: Whether ids without ratings get the mean of the averages, otherwise they are dropped.
+    :return: A series of the average rating of each id.
     """
-    avg_rating_series = observed_ratings_df.loc[:, 'rating'].reset_index()[["userId", "rating"]].groupby("userId").mean()
+    rated_totals = totals[totals['count'] > 0]
+    averages = (rated_totals['sum'] / rated_totals['count']).rename('rating')
     if fill_na:
-        avg_rating_series = avg_rating_series.reindex(unique_users, fill_value=avg_rating_series.mean()['rating'])
-    write(avg_rating_series, 'avg_user_rating_obs', path)
+        averages = averages.reindex(totals.index, fill_value=averages.mean())
+    return averages
 
 
 def item_predicate(observed_ratings_df, truth_ratings_df, path):
@@ -116,19 +174,53 @@ def nmf_ratings_predicate(observed_ratings_df, truth_ratings_df, path):
     reader = Reader(rating_scale=(0.2, 1))
     train_dataset = Dataset.load_from_df(df=observed_ratings_df.reset_index().loc[:, ['userId', 'movieId', 'rating']],
                                          reader=reader)
-    nmf_model.fit(train_dataset.build_full_trainset())
+    trainset = train_dataset.build_full_trainset()
+    nmf_model.fit(trainset)
 
     # make predictions
-    predictions = pd.DataFrame(index=truth_ratings_df.index, columns=['rating'])
-
-    for row in truth_ratings_df.loc[:, ['rating']].iterrows():
-        uid = row[0][0]
-        iid = row[0][1]
-        predictions.loc[(uid, iid), 'rating'] = np.clip(nmf_model.predict(uid, iid).est, 0.0, 1.0)
+    estimates = nmf_batch_predict(nmf_model, trainset,
+                                  truth_ratings_df.index.get_level_values('userId'),
+                                  truth_ratings_df.index.get_level_values('movieId'))
+    predictions = pd.DataFrame(data={'rating': np.clip(estimates, 0.0, 1.0)}, index=truth_ratings_df.index)
 
     write(predictions, 'nmf_rating_obs', path)
 
 
+def nmf_batch_predict(nmf_model, trainset, user_ids, item_ids):
+    """
+    Predict the ratings of many user item pairs at once with a fitted surprise NMF model.
+    Gives the same estimates as calling nmf_model.predict(uid, iid).est for each pair.
+    :param nmf_model: The surprise NMF model fitted on the trainset.
+    :param trainset: The surprise trainset the model was fitted on.
+    :param user_ids: The raw user ids of the pairs.
+    :param item_ids: The raw item ids of the pairs.
+    :return: A numpy array of the estimated ratings clipped to the trainset rating scale.
+    """
+    # Map raw ids to inner ids once. Unknown ids are mapped to -1.
+    raw_user_ids = pd.Index([trainset.to_raw_uid(inner_id) for inner_id in trainset.all_users()])
+    raw_item_ids = pd.Index([trainset.to_raw_iid(inner_id) for inner_id in trainset.all_items()])
+    inner_user_ids = raw_user_ids.get_indexer(user_ids)
+    inner_item_ids = raw_item_ids.get_indexer(item_ids)
+    known_users = inner_user_ids != -1
+    known_items = inner_item_ids != -1
+    known_pairs = known_users & known_items
+
+    estimates = np.zeros(len(inner_user_ids))
+    estimates[known_pairs] = np.einsum('ij,ij->i',
+                                       nmf_model.qi[inner_item_ids[known_pairs]],
+                                       nmf_model.pu[inner_user_ids[known_pairs]])
+    if nmf_model.biased:
+        estimates += trainset.global_mean
+        estimates[known_users] += nmf_model.bu[inner_user_ids[known_users]]
+        estimates[known_items] += nmf_model.bi[inner_item_ids[known_items]]
+    else:
+        # Predictions for unknown users or items fall back to the default prediction.
+        estimates[~known_pairs] = nmf_model.default_prediction()
+
+    lower_bound, higher_bound = trainset.rating_scale
+    return np.clip(estimates, lower_bound, higher_bound)
+
+
 def rated_predicate(observed_ratings_df, truth_ratings_df, path, partition):
     """
     Rated Predicates.
@@ -197,19 +289,36 @@ def sim_content_predicate(movies_df, path):
     write(top_n_cosine_sim(movie_genres_matrix, movie_genres_df.index, 50), 'sim_content_items_obs', path)
 
 
-def sim_items_predicate(observed_ratings_df, path):
+def sim_items_predicate(ratings_matrix, movies, path):
     """
     Item Similarity Predicate: sim_cosine_items, built only from observed ratings.
+    :param ratings_matrix: The sparse users x movies matrix of observed ratings, see sparse_ratings_matrix.
+    :param movies: The movie ids labeling the columns of the ratings matrix.
     """
     # Cosine similarity.
-    movie_ratings_matrix = observed_ratings_df.rating.unstack().fillna(0).T.values
-    write(top_n_cosine_sim(movie_ratings_matrix, observed_ratings_df.rating.unstack().columns, 50), 'sim_items_obs', path)
+    write(top_n_cosine_sim(ratings_matrix.T.tocsr(), movies, 50), 'sim_items_obs', path)
 
 
-def sim_users_predicate(observed_ratings_df, path):
+def sim_users_predicate(ratings_matrix, users, path):
     """
     User Similarity Predicate: sim_cosine_users, built only from observed ratings
+    :param ratings_matrix: The sparse users x movies matrix of observed ratings, see sparse_ratings_matrix.
+    :param users: The user ids labeling the rows of the ratings matrix.
     """
     # Cosine similarity.
-    user_ratings_matrix = observed_ratings_df.rating.unstack().fillna(0).values
-    write(top_n_cosine_sim(user_ratings_matrix, observed_ratings_df.rating.unstack().index, 50), 'sim_users_obs', path)
+    write(top_n_cosine_sim(ratings_matrix, users, 50), 'sim_users_obs', path)
+
+
+def sparse_ratings_matrix(observed_ratings_df):
+    """
+    Build the sparse users x movies matrix of observed ratings.
+    Unrated user-movie pairs are implicit zeros.
+    :param observed_ratings_df: The observed ratings frame indexed by (userId, movieId).
+    :return: The csr ratings matrix, the user ids labeling its rows, and the movie ids labeling its columns.
+    """
+    user_codes, users = pd.factorize(observed_ratings_df.index.get_level_values('userId'), sort=True)
+    movie_codes, movies = pd.factorize(observed_ratings_df.index.get_level_values('movieId'), sort=True)
+    ratings_matrix = sparse.csr_matrix((observed_ratings_df.rating.values, (user_codes, movie_codes)),
+                                       shape=(len(users), len(movies)))
+
+    return ratings_matrix, users, movies
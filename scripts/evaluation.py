@@ -1,52 +1,43 @@
 import os
 import re
 import sys
+import tempfile
 import pandas as pd
 import numpy as np
 
-
 from scipy.stats import pearsonr
 from math import sqrt
 
+import ranking_metrics
+
+# A predicate as its int64 key from encode_keys and its value.
+PREDICATE_RECORD = np.dtype([('key', np.int64), ('value', np.float64)])
+
 def pearson_correlation(prediction_list, truth_list):
     return pearsonr(prediction_list, truth_list)[0]
 
 
 def rmse(prediction_list, truth_list):
-    rmse = 0
-    for prediction, truth in zip(prediction_list, truth_list):
-        rmse += (float(prediction) - float(truth))**2
+    errors = np.asarray(prediction_list, dtype=float) - np.asarray(truth_list, dtype=float)
+    return sqrt(np.dot(errors, errors) / len(truth_list))
 
-    return sqrt(rmse / len(truth_list))
 
+def f1(prediction_list, truth_list, threshold=0.5):
+    predicted = np.asarray(prediction_list, dtype=float) >= threshold
+    actual = np.asarray(truth_list, dtype=float) >= threshold
+    return _f1_score(np.sum(predicted & actual), np.sum(predicted & ~actual), np.sum(~predicted & actual))
 
-def mrr(truth_dict, pred_dict):
-    df_columns = ['user_id', 'movie_id', 'rating']
-    pred_df = pd.Series(pred_dict).reset_index()
-
-    pred_df.columns = df_columns
-
-    # create truth dict for just this iteration
-    fold_truth_dict = dict({})
-    for key in pred_dict.keys():
-        if key not in truth_dict.keys():
-            continue
-        fold_truth_dict[key] = truth_dict[key]
 
-    truth_df = pd.Series(fold_truth_dict).reset_index()
-    truth_df.columns = df_columns
+def _f1_score(true_positives, false_positives, false_negatives):
+    if true_positives == 0:
+        return 0.0
+    return float(2 * true_positives / (2 * true_positives + false_positives + false_negatives))
 
-    mrr = 0
-    user_count = len(truth_df.user_id.unique())
-    for user in truth_df.user_id.unique():
-        user_truth_ratings = truth_df.loc[truth_df.user_id == user].sort_values(by=['rating'], ascending=False).reset_index()
-        user_pred_ratings = pred_df.loc[pred_df.user_id == user].sort_values(by=['rating'], ascending=False).reset_index()
 
-        most_recommended = user_truth_ratings.loc[user_truth_ratings.rating == user_truth_ratings.rating.max()].movie_id.values
-        pred_rank = user_pred_ratings.loc[user_pred_ratings.movie_id.isin(most_recommended)].index[0] + 1
-
-        mrr += float(1 / pred_rank)
-    return float(mrr / user_count)
+def mrr(truth_dict, pred_dict):
+    pred_df = pd.DataFrame([key + (rating,) for key, rating in pred_dict.items()])
+    truth_df = pd.DataFrame([key + (rating,) for key, rating in truth_dict.items()])
+    return ranking_metrics.ranking_metrics(pred_df, truth_df)['mrr']
 
 
 def create_lists(predictions_path, truth_dict):
@@ -98,3 +89,211 @@ def load_truth(data_path):
                         truth_dict[tuple(parts[:-1])] = float(parts[-1])
 
     return truth_dict
+
+
+def load_predicates(predicates_path, chunk_size=None):
+    """
+    Read a PSL predicate file of argument columns followed by a value column.
+    Columns are typed by the csv parser rather than kept as strings.
+    :param chunk_size: If given, return an iterator over frames of at most this many rows.
+    """
+    return pd.read_csv(predicates_path, header=None, sep='\t', chunksize=chunk_size)
+
+
+def encode_keys(arguments_df, argument_values):
+    """
+    Encode the argument columns of each row as one int64 key.
+    Each argument is replaced by its position in argument_values and the positions are combined in mixed radix.
+    :param argument_values: One pd.Index of the known values of each argument.
+    :return: The keys, -1 for rows with an argument value that is not known.
+    """
+    keys = np.zeros(arguments_df.shape[0], dtype=np.int64)
+    unknown = np.zeros(arguments_df.shape[0], dtype=bool)
+    for column, values in zip(arguments_df.columns, argument_values):
+        codes = values.get_indexer(arguments_df[column])
+        unknown |= codes == -1
+        keys = keys * len(values) + codes
+
+    keys[unknown] = -1
+    return keys
+
+
+def evaluate_predictions(predictions_path, truth_path, metrics=('rmse',), threshold=0.5, chunk_size=10 ** 6):
+    """
+    Evaluate inferred predicates against their truth, in memory bounded by the chunk size rather than the file sizes.
+    The truth and the predictions are streamed in chunks of (int64 key, value) records.
+    A truth of more than one chunk is first partitioned by key into binary files of about one chunk each,
+    with the predictions partitioned alike.
+    Each truth partition is held as sorted keys, and the predictions are joined to it by binary search
+    and folded into running statistics.
+    Predictions without truth are ignored, truth without a prediction is counted as 'unmatched_truth'.
+    :param metrics: Names of the metrics to compute, any of 'rmse', 'pearson_correlation', 'f1' and 'unmatched_truth'.
+    :param threshold: Value at and above which predictions and truth are positive for f1.
+    :param chunk_size: The number of rows read at a time, and about the number of truth rows held at once.
+    :return: Dict of metric name to value.
+    """
+    argument_values, truth_count = _argument_values(truth_path, chunk_size)
+    partition_count = -(-truth_count // chunk_size)
+
+    statistics = _initial_statistics()
+    if partition_count <= 1:
+        truth_records = _concatenate_records(_predicate_records(truth_path, argument_values, chunk_size))
+        _join_partition(statistics, truth_records,
+                        _predicate_records(predictions_path, argument_values, chunk_size), threshold)
+    else:
+        with tempfile.TemporaryDirectory() as partition_dir:
+            _write_partitions(_predicate_records(truth_path, argument_values, chunk_size),
+                              os.path.join(partition_dir, 'truth'), partition_count)
+            _write_partitions(_predicate_records(predictions_path, argument_values, chunk_size),
+                              os.path.join(partition_dir, 'predictions'), partition_count)
+
+            for partition in range(partition_count):
+                truth_records = _concatenate_records(_read_partition(os.path.join(partition_dir, 'truth'), partition))
+                _join_partition(statistics, truth_records,
+                                _read_partition(os.path.join(partition_dir, 'predictions'), partition, chunk_size),
+                                threshold)
+
+    return {metric: _statistics_metric(statistics, metric) for metric in metrics}
+
+
+def _argument_values(predicates_path, chunk_size):
+    """
+    Stream a predicate file for the values of each argument and its number of rows.
+    """
+    argument_values = None
+    count = 0
+    for predicates_df in load_predicates(predicates_path, chunk_size=chunk_size):
+        arguments_df = predicates_df.iloc[:, :-1]
+        chunk_values = [pd.Index(arguments_df[column].unique()) for column in arguments_df.columns]
+        if argument_values is None:
+            argument_values = chunk_values
+        else:
+            argument_values = [values.append(new_values).unique()
+                               for values, new_values in zip(argument_values, chunk_values)]
+        count += predicates_df.shape[0]
+
+    return argument_values, count
+
+
+def _predicate_records(predicates_path, argument_values, chunk_size):
+    """
+    Stream a predicate file as arrays of (key, value) records.
+    Rows with an argument value that is not known are dropped.
+    """
+    for predicates_df in load_predicates(predicates_path, chunk_size=chunk_size):
+        records = np.empty(predicates_df.shape[0], dtype=PREDICATE_RECORD)
+        records['key'] = encode_keys(predicates_df.iloc[:, :-1], argument_values)
+        records['value'] = predicates_df.iloc[:, -1].values.astype(float)
+        yield records[records['key'] != -1]
+
+
+def _concatenate_records(record_chunks):
+    return np.concatenate([np.empty(0, dtype=PREDICATE_RECORD)] + list(record_chunks))
+
+
+def _write_partitions(record_chunks, path_prefix, partition_count):
+    """
+    Append each chunk of records to the binary file of its partition, key modulo partition_count.
+    """
+    for records in record_chunks:
+        partitions = records['key'] % partition_count
+        for partition in np.unique(partitions):
+            with open('{}.{}'.format(path_prefix, partition), 'ab') as partition_file:
+                records[partitions == partition].tofile(partition_file)
+
+
+def _read_partition(path_prefix, partition, chunk_size=-1):
+    """
+    Stream the records of a partition in chunks of at most chunk_size records, all at once if -1.
+    """
+    partition_path = '{}.{}'.format(path_prefix, partition)
+    if not os.path.exists(partition_path):
+        return
+
+    with open(partition_path, 'rb') as partition_file:
+        while True:
+            records = np.fromfile(partition_file, dtype=PREDICATE_RECORD, count=chunk_size)
+            if len(records) == 0:
+                return
+            yield records
+
+
+def _join_partition(statistics, truth_records, prediction_record_chunks, threshold):
+    """
+    Join chunks of prediction records to the truth records with the same keys and fold them into the statistics.
+    """
+    truth_records = truth_records[np.argsort(truth_records['key'], kind='stable')]
+    truth_matched = np.zeros(len(truth_records), dtype=bool)
+
+    if len(truth_records) > 0:
+        for prediction_records in prediction_record_chunks:
+            positions = np.minimum(np.searchsorted(truth_records['key'], prediction_records['key']), len(truth_records) - 1)
+            matched = truth_records['key'][positions] == prediction_records['key']
+            truth_matched[positions[matched]] = True
+
+            _update_statistics(statistics, prediction_records['value'][matched],
+                               truth_records['value'][positions[matched]], threshold)
+
+    statistics['unmatched_truth'] += int(np.count_nonzero(~truth_matched))
+
+
+def _initial_statistics():
+    return {'count': 0, 'squared_error': 0.0,
+            'prediction_mean': 0.0, 'truth_mean': 0.0,
+            'prediction_m2': 0.0, 'truth_m2': 0.0, 'co_moment': 0.0,
+            'true_positives': 0, 'false_positives': 0, 'false_negatives': 0,
+            'unmatched_truth': 0}
+
+
+def _update_statistics(statistics, predictions, truths, threshold):
+    """
+    Fold a chunk of matched predictions and truths into the running statistics.
+    Means and second moments are merged pairwise so the correlation stays stable over many chunks.
+    """
+    chunk_count = len(predictions)
+    if chunk_count == 0:
+        return
+
+    errors = predictions - truths
+    statistics['squared_error'] += np.dot(errors, errors)
+
+    predicted = predictions >= threshold
+    actual = truths >= threshold
+    statistics['true_positives'] += int(np.sum(predicted & actual))
+    statistics['false_positives'] += int(np.sum(predicted & ~actual))
+    statistics['false_negatives'] += int(np.sum(~predicted & actual))
+
+    chunk_prediction_mean = predictions.mean()
+    chunk_truth_mean = truths.mean()
+    prediction_deviations = predictions - chunk_prediction_mean
+    truth_deviations = truths - chunk_truth_mean
+
+    count = statistics['count']
+    total_count = count + chunk_count
+    prediction_delta = chunk_prediction_mean - statistics['prediction_mean']
+    truth_delta = chunk_truth_mean - statistics['truth_mean']
+    weight = count * chunk_count / total_count
+
+    statistics['prediction_m2'] += np.dot(prediction_deviations, prediction_deviations) + prediction_delta ** 2 * weight
+    statistics['truth_m2'] += np.dot(truth_deviations, truth_deviations) + truth_delta ** 2 * weight
+    statistics['co_moment'] += np.dot(prediction_deviations, truth_deviations) + prediction_delta * truth_delta * weight
+    statistics['prediction_mean'] += prediction_delta * chunk_count / total_count
+    statistics['truth_mean'] += truth_delta * chunk_count / total_count
+    statistics['count'] = total_count
+
+
+def _statistics_metric(statistics, metric):
+    if metric == 'unmatched_truth':
+        return statistics['unmatched_truth']
+
+    if statistics['count'] == 0:
+        return np.nan
+
+    if metric == 'rmse':
+        return sqrt(statistics['squared_error'] / statistics['count'])
+    if metric == 'pearson_correlation':
+        return float(statistics['co_moment'] / sqrt(statistics['prediction_m2'] * statistics['truth_m2']))
+    if metric == 'f1':
+        return _f1_score(statistics['true_positives'], statistics['false_positives'], statistics['false_negatives'])
+
+    raise ValueError("Unknown metric: %s" % (metric))
@@ -4,35 +4,109 @@ import sys
 import pandas as pd
 import numpy as np
 
+# Seed of the random fill values when none is given, so hot start files are reproducible.
+DEFAULT_SEED = 0
 
-def main(inferred_predicates_path, split_targets_path):
-    inferred_predicates_df = pd.read_csv(inferred_predicates_path, header=None, sep="\t")
-    inferred_predicates_df = inferred_predicates_df.set_index(list(range(inferred_predicates_df.shape[1] - 1)))
 
-    split_targets_df = pd.read_csv(split_targets_path, header=None, sep="\t")
-    split_targets_df = split_targets_df.set_index(list(range(split_targets_df.shape[1])))
+def main(inferred_predicates_path, split_targets_path, seed=DEFAULT_SEED, chunk_size=None):
+    """
+    Write the hotstart file of the split targets with their previously inferred values.
+    Targets without an inferred value are filled with a random [0, 1) value.
+    :param seed: Seed of the random fill values.
+    :param chunk_size: If given, stream the targets in chunks of at most this many rows.
+    """
+    inferred_predicates_df = read_predicates(inferred_predicates_path, has_value=True)
+    inferred_arguments = inferred_predicates_df.iloc[:, :-1].values
+    inferred_values = inferred_predicates_df.iloc[:, -1].values
 
-    hot_start_atom_df = inferred_predicates_df.reindex(split_targets_df.index)
-    # Fill potentially missing values with random [0, 1) value.
-    hot_start_atom_df[hot_start_atom_df.columns[0]] = hot_start_atom_df[hot_start_atom_df.columns[0]].apply(
-        lambda x: np.random.random() if pd.isna(x) else x)
+    # Encode inferred arguments as sorted int64 keys to merge targets against.
+    minimums = inferred_arguments.min(axis=0)
+    sizes = inferred_arguments.max(axis=0) - minimums + 1
+    inferred_keys = encode_keys(inferred_arguments, minimums, sizes)
+    inferred_order = np.argsort(inferred_keys, kind='stable')
+    inferred_keys = inferred_keys[inferred_order]
+    inferred_values = inferred_values[inferred_order]
 
-    # Write hotstart file.
-    hot_start_atom_df.to_csv(os.path.join(os.path.dirname(split_targets_path), "hotstart_target.txt"),
-                             sep="\t", header=False)
+    rng = np.random.default_rng(seed)
+    hot_start_path = os.path.join(os.path.dirname(split_targets_path), "hotstart_target.txt")
+
+    split_targets_chunks = read_predicates(split_targets_path, has_value=False, chunk_size=chunk_size)
+    if chunk_size is None:
+        split_targets_chunks = [split_targets_chunks]
+
+    write_mode = 'w'
+    for split_targets_df in split_targets_chunks:
+        target_keys = encode_keys(split_targets_df.values, minimums, sizes)
+        positions = np.minimum(np.searchsorted(inferred_keys, target_keys), len(inferred_keys) - 1)
+        found = (target_keys != -1) & (inferred_keys[positions] == target_keys)
+
+        hot_start_values = np.empty(len(target_keys))
+        hot_start_values[found] = inferred_values[positions[found]]
+        # Fill potentially missing values with random [0, 1) value.
+        hot_start_values[~found] = rng.random(np.count_nonzero(~found))
+
+        # Write hotstart file.
+        hot_start_atom_df = split_targets_df.copy()
+        hot_start_atom_df[hot_start_atom_df.shape[1]] = hot_start_values
+        hot_start_atom_df.to_csv(hot_start_path, sep="\t", header=False, index=False, mode=write_mode)
+        write_mode = 'a'
+
+
+def read_predicates(predicates_path, has_value, chunk_size=None):
+    """
+    Read a predicate file with int64 arguments and, if it has one, a float64 value column.
+    """
+    with open(predicates_path, 'r') as predicates_file:
+        column_count = len(predicates_file.readline().rstrip('\n').split('\t'))
+
+    argument_count = column_count - 1 if has_value else column_count
+    dtype = {column: np.int64 for column in range(argument_count)}
+    if has_value:
+        dtype[argument_count] = np.float64
+
+    return pd.read_csv(predicates_path, header=None, sep="\t", dtype=dtype, chunksize=chunk_size)
+
+
+def encode_keys(arguments, minimums, sizes):
+    """
+    Encode each row of int arguments as one int64 key, in mixed radix of the argument ranges.
+    :return: The keys, -1 for rows with an argument outside of its range.
+    """
+    keys = np.zeros(arguments.shape[0], dtype=np.int64)
+    outside = np.zeros(arguments.shape[0], dtype=bool)
+    for column in range(arguments.shape[1]):
+        offsets = arguments[:, column] - minimums[column]
+        outside |= (offsets < 0) | (offsets >= sizes[column])
+        keys = keys * sizes[column] + offsets
+
+    keys[outside] = -1
+    return keys
 
 
 def _load_args(args):
     executable = args.pop(0)
-    if len(args) != 2 or ({'h', 'help'} & {arg.lower().strip().replace('-', '') for arg in args}):
-        print("USAGE: python3 %s <inferred_predicates_path> <split_targets_path>" % (executable), file=sys.stderr)
+
+    seed = DEFAULT_SEED
+    chunk_size = None
+    positional_args = []
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '--seed' and len(args) > 0:
+            seed = int(args.pop(0))
+        elif arg == '--chunk-size' and len(args) > 0:
+            chunk_size = int(args.pop(0))
+        else:
+            positional_args.append(arg)
+
+    if len(positional_args) != 2 or ({'h', 'help'} & {arg.lower().strip().replace('-', '') for arg in positional_args}):
+        print("USAGE: python3 %s <inferred_predicates_path> <split_targets_path> [--seed <seed>] [--chunk-size <rows>]" % (executable), file=sys.stderr)
         sys.exit(1)
 
-    arg_1 = args.pop(0)
-    arg_2 = args.pop(0)
-    return arg_1, arg_2
+    arg_1 = positional_args.pop(0)
+    arg_2 = positional_args.pop(0)
+    return arg_1, arg_2, seed, chunk_size
 
 
 if __name__ == '__main__':
-    inferred_predicates_path, split_targets_path = _load_args(sys.argv)
-    main(inferred_predicates_path, split_targets_path)
+    inferred_predicates_path, split_targets_path, seed, chunk_size = _load_args(sys.argv)
+    main(inferred_predicates_path, split_targets_path, seed=seed, chunk_size=chunk_size)
@@ -0,0 +1,244 @@
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Log modes.
+ONLINE = "online"
+TEMPLATE_MODIFICATION = "template_modification"
+OFFLINE = "offline"
+MODES = [ONLINE, TEMPLATE_MODIFICATION, OFFLINE]
+
+# Parsing keywords.
+KEYWORDS = {
+    "online_start": "Optimization Start",
+    "online_end": "Optimization End",
+    "online_write": "Writing inferred predicates to file:",
+    "offline_start": "Beginning inference.",
+    "offline_end": "Inference Complete",
+    "alpha_min": "Alpha min",
+    "beta_max": "Beta max",
+    "beta_avg": "Beta average",
+    "betas": "Observed rates of change of gradients (Beta)",
+    "l_max": "L max",
+    "l_avg": "L average",
+    "regret_objective": "Initial Objective:",
+    "regret_norm_objective": "Initial Normalized Objective:",
+    "var_movement": "- Movement of variables from initial state",
+    "var_delta": "variable delta",
+    "initial_gradient": "Initial observed magnitude of gradient",
+    "delta_model_grad_mag": "Delta model change in gradient:",
+    "approx_delta_model_grad_mag": "Approximation Delta Model Gradient Magnitude",
+    "final_objective": "Final Normalized Objective:",
+}
+
+# Every keyword in one pattern, the name of the matched group is the keyword.
+LOG_PATTERN = re.compile('|'.join('(?P<%s>%s)' % (name, re.escape(keyword)) for name, keyword in KEYWORDS.items()))
+
+# Properties whose value is the last token of their line.
+LAST_TOKEN_PROPERTIES = {"alpha_min", "beta_max", "beta_avg", "l_max", "l_avg", "var_movement", "var_delta",
+                         "initial_gradient", "delta_model_grad_mag", "approx_delta_model_grad_mag"}
+
+TABLE_COLUMNS = {
+    "time_step": "int64",
+    "start_time": "float64",
+    "end_time": "float64",
+    "time": "float64",
+    "alpha_min": "float64",
+    "beta_max": "float64",
+    "beta_avg": "float64",
+    "l_max": "float64",
+    "l_avg": "float64",
+    "var_movement": "float64",
+    "var_delta": "float64",
+    "initial_gradient": "float64",
+    "delta_model_grad_mag": "float64",
+    "final_obj": "float64",
+    "final_norm_obj": "float64",
+}
+
+
+def to_float(token):
+    """
+    Parse a logged number, NaN if the token is not a number.
+    """
+    try:
+        return float(token.strip(','))
+    except ValueError:
+        return np.nan
+
+
+def parse_betas(text):
+    """
+    Parse a logged list of numbers, e.g. "[0.1, 0.2, NaN]", without evaluating it.
+    """
+    return np.array([to_float(value) for value in text.strip().strip('[]').split(',') if value.strip() != ''])
+
+
+def parse_line(name, line):
+    """
+    Get the properties logged on a line that matched the keyword with the given name.
+    """
+    if name in LAST_TOKEN_PROPERTIES:
+        return {name: to_float(line.split()[-1])}
+
+    if name in ("online_start", "offline_start"):
+        return {"start_time": to_float(line.split()[0])}
+
+    if name in ("online_end", "offline_end"):
+        return {"end_time": to_float(line.split()[0])}
+
+    if name == "online_write":
+        return {"end_time": to_float(line.split()[0]), "written_time_step": line.split()[-1].split('/')[-1]}
+
+    if name == "betas":
+        return {"betas": parse_betas(line.split(':')[-1])}
+
+    if name == "final_objective":
+        tokens = line.split()
+        return {"final_obj": to_float(tokens[-9]), "final_norm_obj": to_float(tokens[-5])}
+
+    if name in ("regret_objective", "regret_norm_objective"):
+        return {name: to_float(line.split(':')[1])}
+
+    return {}
+
+
+def iterate_properties(log_path):
+    """
+    Stream the properties logged in a file, in order, as (keyword name, properties) pairs.
+    """
+    with open(log_path, 'r') as log_file:
+        for line in log_file:
+            for match in LOG_PATTERN.finditer(line):
+                yield match.lastgroup, parse_line(match.lastgroup, line.strip())
+
+
+def parse_log(log_path, mode=ONLINE, time_step=0):
+    """
+    Parse a PSL log into a typed table of timing and model properties with one row per time step.
+    Properties that are not logged again in a time step keep their value from the previous time step.
+    :param mode: ONLINE for server logs with one optimization per time step,
+                 TEMPLATE_MODIFICATION for server logs whose time steps end when inferred predicates are written,
+                 or OFFLINE for the log of a single offline inference.
+    :param time_step: The time step of an OFFLINE log.
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown log mode: %s" % (mode))
+
+    properties = {}
+    rows = []
+    for name, line_properties in iterate_properties(log_path):
+        properties.update(line_properties)
+
+        if mode == ONLINE and name == "online_end":
+            rows.append(_table_row(properties, time_step))
+            time_step += 1
+
+        if mode == TEMPLATE_MODIFICATION and name == "online_write":
+            if properties["written_time_step"] == "inferred-predicates":
+                break
+            rows.append(_table_row(properties, int(properties["written_time_step"])))
+
+    if mode == OFFLINE:
+        rows.append(_table_row(properties, time_step))
+
+    return pd.DataFrame(rows, columns=list(TABLE_COLUMNS.keys())).astype(TABLE_COLUMNS)
+
+
+def _table_row(properties, time_step):
+    row = {column: properties.get(column, np.nan) for column in TABLE_COLUMNS}
+    row["time_step"] = time_step
+    row["time"] = row["end_time"] - row["start_time"]
+    if "betas" in properties:
+        row["beta_avg"] = properties["betas"].mean()
+    return row
+
+
+def parse_regret_log(log_path):
+    """
+    Get the last logged initial objective and initial normalized objective of a regret run, 0 if not logged.
+    """
+    properties = {"regret_objective": 0.0, "regret_norm_objective": 0.0}
+    for name, line_properties in iterate_properties(log_path):
+        if name in properties:
+            properties.update(line_properties)
+    return properties["regret_objective"], properties["regret_norm_objective"]
+
+
+def parse_approx_delta_model_log(log_path):
+    """
+    Get every logged approximation delta model gradient magnitude, in order.
+    """
+    return np.array([line_properties["approx_delta_model_grad_mag"]
+                     for name, line_properties in iterate_properties(log_path)
+                     if name == "approx_delta_model_grad_mag"])
+
+
+def parquet_available():
+    """
+    Check whether a Parquet engine, pyarrow or fastparquet, can be imported.
+    """
+    for engine in ('pyarrow', 'fastparquet'):
+        try:
+            __import__(engine)
+            return True
+        except ImportError:
+            pass
+    return False
+
+
+def load_log_table(log_path, mode=ONLINE, time_step=0, table_path=None):
+    """
+    Load the table of a PSL log through a Parquet file next to the log.
+    The log is parsed again when it is newer than the Parquet file.
+    Without a Parquet engine the log is parsed every time and the table is not cached.
+    :param table_path: The Parquet file, by default the log path with a .parquet extension.
+    """
+    if not parquet_available():
+        return parse_log(log_path, mode=mode, time_step=time_step)
+
+    if table_path is None:
+        table_path = os.path.splitext(log_path)[0] + '.parquet'
+
+    if os.path.exists(table_path) and os.path.getmtime(table_path) >= os.path.getmtime(log_path):
+        return pd.read_parquet(table_path)
+
+    table = parse_log(log_path, mode=mode, time_step=time_step)
+    table.to_parquet(table_path, index=False)
+    return table
+
+
+def main(log_path, table_path, mode):
+    if not parquet_available():
+        print("Writing Parquet tables requires pyarrow or fastparquet.", file=sys.stderr)
+        sys.exit(1)
+
+    table = parse_log(log_path, mode=mode)
+    table.to_parquet(table_path, index=False)
+
+
+def _load_args(args):
+    executable = args.pop(0)
+    if len(args) not in (2, 3) or ({'h', 'help'} & {arg.lower().strip().replace('-', '') for arg in args}):
+        print("USAGE: python3 %s <log_path> <table_path> [%s]" % (executable, '|'.join(MODES)), file=sys.stderr)
+        sys.exit(1)
+
+    log_path = args.pop(0)
+    table_path = args.pop(0)
+    mode = ONLINE
+    if len(args) > 0:
+        mode = args.pop(0)
+
+    if mode not in MODES:
+        print("Unknown log mode: %s" % (mode), file=sys.stderr)
+        sys.exit(1)
+
+    return log_path, table_path, mode
+
+
+if __name__ == '__main__':
+    log_path, table_path, mode = _load_args(sys.argv)
+    main(log_path, table_path, mode)
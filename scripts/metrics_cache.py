@@ -0,0 +1,75 @@
+import os
+import sqlite3
+
+import evaluation
+
+THIS_DIR = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_CACHE_PATH = os.path.join(THIS_DIR, '..', 'results', 'metrics_cache.sqlite')
+
+CREATE_TABLE_QUERY = '''
+    CREATE TABLE IF NOT EXISTS metrics (
+        predictions_path TEXT NOT NULL,
+        predictions_size INTEGER NOT NULL,
+        predictions_mtime INTEGER NOT NULL,
+        truth_path TEXT NOT NULL,
+        truth_size INTEGER NOT NULL,
+        truth_mtime INTEGER NOT NULL,
+        metric TEXT NOT NULL,
+        threshold REAL NOT NULL,
+        value REAL,
+        PRIMARY KEY (predictions_path, truth_path, metric, threshold)
+    )
+'''
+
+
+def open_cache(cache_path=DEFAULT_CACHE_PATH, timeout=60.0):
+    """
+    Open the metrics cache, creating it if it does not exist.
+    :param timeout: Seconds to wait for other processes writing to the cache.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    connection = sqlite3.connect(cache_path, timeout=timeout)
+    connection.execute(CREATE_TABLE_QUERY)
+    return connection
+
+
+def file_fingerprint(path):
+    """
+    Get the absolute path, size and modification time in nanoseconds of a file.
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def cached_evaluation(connection, predictions_path, truth_path, metrics=('rmse',), threshold=0.5):
+    """
+    Evaluate inferred predicates against their truth through the metrics cache.
+    Cached metrics are used while both files keep the size and modification time they were evaluated with,
+    otherwise the predictions are evaluated again and the cache is updated.
+    :return: Dict of metric name to value.
+    """
+    predictions_fingerprint = file_fingerprint(predictions_path)
+    truth_fingerprint = file_fingerprint(truth_path)
+
+    results = {}
+    for metric in metrics:
+        row = connection.execute(
+            'SELECT value FROM metrics WHERE predictions_path = ? AND predictions_size = ? AND predictions_mtime = ?'
+            ' AND truth_path = ? AND truth_size = ? AND truth_mtime = ? AND metric = ? AND threshold = ?',
+            predictions_fingerprint + truth_fingerprint + (metric, threshold)).fetchone()
+        if row is not None:
+            results[metric] = row[0]
+
+    missing_metrics = [metric for metric in metrics if metric not in results]
+    if len(missing_metrics) == 0:
+        return results
+
+    evaluated = evaluation.evaluate_predictions(predictions_path, truth_path, metrics=missing_metrics, threshold=threshold)
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [predictions_fingerprint + truth_fingerprint + (metric, threshold, float(value))
+             for metric, value in evaluated.items()])
+
+    results.update(evaluated)
+    return results
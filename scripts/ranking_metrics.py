@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+
+def ranking_metrics(predictions_df, truth_df, k=10, relevance_threshold=None):
+    """
+    Compute the MRR, NDCG@k and precision@k of the predicted rankings of every user.
+    Predictions are sorted once by (user, score) and ranked within users, ties keep their order in the predictions.
+    Only predictions with a truth value are judged, and users are those with at least one judged prediction.
+    :param predictions_df: Frame of user, item and predicted score columns.
+    :param truth_df: Frame of user, item and true rating columns.
+    :param relevance_threshold: Rating at and above which an item is relevant.
+                                If None, the items with a user's highest true rating are relevant.
+    :return: Dict with the 'mrr', 'ndcg' and 'precision' averaged over users.
+    """
+    predictions_df = pd.DataFrame({'user': predictions_df.iloc[:, 0].values,
+                                   'item': predictions_df.iloc[:, 1].values,
+                                   'score': predictions_df.iloc[:, 2].values.astype(float)})
+    truth_df = pd.DataFrame({'user': truth_df.iloc[:, 0].values,
+                             'item': truth_df.iloc[:, 1].values,
+                             'truth': truth_df.iloc[:, 2].values.astype(float)})
+
+    # Rank each user's predictions by descending score.
+    ranked_df = predictions_df.sort_values(['user', 'score'], ascending=[True, False])
+    ranked_df['rank'] = ranked_df.groupby('user', sort=False).cumcount() + 1
+
+    judged_df = ranked_df.merge(truth_df, on=['user', 'item'], how='inner')
+    users = pd.Index(judged_df.user.unique())
+    if len(users) == 0:
+        return {'mrr': np.nan, 'ndcg': np.nan, 'precision': np.nan}
+
+    if relevance_threshold is None:
+        relevant = judged_df.truth == judged_df.groupby('user').truth.transform('max')
+    else:
+        relevant = judged_df.truth >= relevance_threshold
+    in_top_k = judged_df['rank'] <= k
+
+    # Reciprocal rank of the first relevant item.
+    first_relevant_rank = judged_df['rank'][relevant].groupby(judged_df.user[relevant]).min()
+    reciprocal_ranks = (1.0 / first_relevant_rank).reindex(users, fill_value=0.0)
+
+    # Fraction of the top k predictions that are relevant.
+    precisions = (relevant & in_top_k).groupby(judged_df.user).sum().reindex(users, fill_value=0) / k
+
+    # Discounted gain of the top k predictions over that of the ideal ranking of the user's truth.
+    gains = judged_df.truth / np.log2(judged_df['rank'] + 1)
+    dcg = gains[in_top_k].groupby(judged_df.user[in_top_k]).sum().reindex(users, fill_value=0.0)
+
+    ideal_df = judged_df.loc[:, ['user', 'truth']].sort_values(['user', 'truth'], ascending=[True, False])
+    ideal_df['rank'] = ideal_df.groupby('user', sort=False).cumcount() + 1
+    ideal_df = ideal_df[ideal_df['rank'] <= k]
+    idcg = (ideal_df.truth / np.log2(ideal_df['rank'] + 1)).groupby(ideal_df.user).sum().reindex(users, fill_value=0.0)
+    ndcgs = (dcg / idcg.where(idcg > 0)).fillna(0.0)
+
+    return {'mrr': float(reciprocal_ranks.mean()),
+            'ndcg': float(ndcgs.mean()),
+            'precision': float(precisions.mean())}
@@ -0,0 +1,244 @@
+import os
+import sys
+
+import pandas as pd
+
+from multiprocessing import Pool
+
+import log_parser
+import metrics_cache
+
+EXPERIMENTS = {
+    "movielens-1m": ["movielens-1m_online", "movielens-1m_time_series"],
+    "epinions": ["selected"],
+    "bikeshare": ["bikeshare_time_series"],
+}
+PSL_VERSION_METHODS = {
+    "online": ["NON_POWERSET", "POWERSET"],
+    "offline": ["SGD_TI"]
+}
+REGRET_FREE_METHOD = {
+    "POWERSET": True,
+    "NON_POWERSET": False,
+    "SGD_TI": True
+}
+INITIALIZATION = ["ATOM", "RANDOM"]
+EVALUATION_METRIC = {
+    "movielens-1m": "rmse",
+    "epinions": "f1",
+    "bikeshare": "pearson_correlation"
+}
+INFERRED_FILE_NAME = {
+    "movielens-1m": "RATING.txt",
+    "epinions": "TRUSTS.txt",
+    "bikeshare": "DEMAND.txt"
+}
+TRUTH_FILE_NAME = {
+    "movielens-1m": "rating_truth.txt",
+    "epinions": "trusts_truth.txt",
+    "bikeshare": "Demand_truth.txt"
+}
+
+# Epinions runs modify the model templates rather than the data, and every time step shares one truth file.
+TEMPLATE_MODIFICATION_DATASETS = ["epinions"]
+
+# Entries of the results tree that are not folds or time steps.
+IGNORED_ENTRIES = {".ipynb_checkpoints", "results.csv", "run.csv", "inferred-predicates"}
+
+RUN_COLUMNS = ["dataset", "experiment", "fold", "psl_version", "method", "initialization"]
+
+# Metrics cache of a results tree, in the root of the tree.
+METRICS_CACHE_FILE_NAME = "metrics_cache.sqlite"
+
+
+def enumerate_runs(results_dir):
+    """
+    List every run in the results tree: results/<dataset>/<experiment>/<fold>/<psl_version>/<method>/<initialization>.
+    """
+    runs = []
+    for dataset, experiments in EXPERIMENTS.items():
+        for experiment in experiments:
+            experiment_path = os.path.join(results_dir, dataset, experiment)
+            if not os.path.isdir(experiment_path):
+                continue
+
+            for fold in sorted(os.listdir(experiment_path)):
+                if fold in IGNORED_ENTRIES:
+                    continue
+
+                for psl_version, methods in PSL_VERSION_METHODS.items():
+                    if psl_version == "online" and dataset in TEMPLATE_MODIFICATION_DATASETS:
+                        methods = ["NON_POWERSET"]
+
+                    for method in methods:
+                        for initialization in INITIALIZATION:
+                            runs.append({
+                                "results_dir": results_dir,
+                                "dataset": dataset,
+                                "experiment": experiment,
+                                "fold": fold,
+                                "psl_version": psl_version,
+                                "method": method,
+                                "initialization": initialization,
+                                "run_path": os.path.join(experiment_path, fold, psl_version, method, initialization),
+                                "regret_run_dir": os.path.join(experiment_path, fold, "regret", "SGD_TI", "ATOM"),
+                                "approx_delta_model_run_dir": os.path.join(experiment_path, fold, "regret_delta_model",
+                                                                           "SGD_TI", "ATOM"),
+                            })
+    return runs
+
+
+def parse_run(run, truth_dir, cache_path=None, cache_tables=True):
+    """
+    Parse the logs and evaluate the inferred predicates of one run into a table with one row per time step.
+    The table is also written to run.csv in the run directory.
+    :param truth_dir: The directory holding <dataset>/data/<dataset> with the truth of each experiment.
+    :param cache_path: The metrics cache, by default the metrics_cache.sqlite in the root of the run's results tree.
+    :param cache_tables: Cache the parsed logs as Parquet tables next to them, if a Parquet engine is installed.
+    """
+    dataset = run["dataset"]
+    template_modification = dataset in TEMPLATE_MODIFICATION_DATASETS
+    regret_free = template_modification or REGRET_FREE_METHOD[run["method"]]
+    load_log = log_parser.load_log_table if cache_tables else log_parser.parse_log
+
+    if run["psl_version"] == "online":
+        mode = log_parser.TEMPLATE_MODIFICATION if template_modification else log_parser.ONLINE
+        run_df = load_log(os.path.join(run["run_path"], "out_server.txt"), mode=mode)
+    else:
+        time_steps = sorted(entry for entry in os.listdir(run["run_path"]) if entry not in IGNORED_ENTRIES)
+        run_df = pd.concat([load_log(os.path.join(run["run_path"], time_step, "out.txt"),
+                                     mode=log_parser.OFFLINE, time_step=int(time_step))
+                            for time_step in time_steps], ignore_index=True)
+        run_df = run_df.drop(columns=["var_delta", "delta_model_grad_mag"])
+
+    # Evaluate the inferred predicates of each time step.
+    if cache_path is None:
+        cache_path = os.path.join(run["results_dir"], METRICS_CACHE_FILE_NAME)
+    connection = metrics_cache.open_cache(cache_path)
+    num_inferred = []
+    num_unmatched_truth = []
+    evaluations = []
+    for time_step in run_df.time_step:
+        inferred_path = os.path.join(time_step_dir(os.path.join(run["run_path"], "inferred-predicates"), time_step),
+                                     INFERRED_FILE_NAME[dataset])
+        if template_modification:
+            truth_path = os.path.join(truth_dir, dataset, "data", dataset, run["fold"], "eval", TRUTH_FILE_NAME[dataset])
+        else:
+            truth_path = os.path.join(truth_dir, dataset, "data", dataset, run["experiment"], run["fold"].zfill(2),
+                                      "eval", str(time_step).zfill(2), TRUTH_FILE_NAME[dataset])
+
+        with open(inferred_path, 'r') as inferred_file:
+            num_inferred.append(sum(1 for _ in inferred_file))
+
+        metric = EVALUATION_METRIC[dataset]
+        evaluated = metrics_cache.cached_evaluation(connection, inferred_path, truth_path,
+                                                    metrics=(metric, "unmatched_truth"))
+        evaluations.append(evaluated[metric])
+        num_unmatched_truth.append(int(evaluated["unmatched_truth"]))
+    connection.close()
+
+    run_df["num_inferred"] = num_inferred
+    run_df["num_unmatched_truth"] = num_unmatched_truth
+    run_df["evaluation"] = evaluations
+
+    # Objectives of the full model, from the regret runs for methods that do not compute them.
+    if regret_free:
+        run_df["full_obj"] = run_df.final_obj
+        run_df["full_norm_obj"] = run_df.final_norm_obj
+    else:
+        regret_objectives = [log_parser.parse_regret_log(os.path.join(run["regret_run_dir"], str(time_step).zfill(2), "out.txt"))
+                             for time_step in run_df.time_step]
+        run_df["full_obj"] = [objective for objective, _ in regret_objectives]
+        run_df["full_norm_obj"] = [norm_objective for _, norm_objective in regret_objectives]
+
+    if run["psl_version"] == "online":
+        if regret_free:
+            run_df["approx_delta_model_grad_mag"] = 0.0
+        else:
+            # The time step's magnitude, or the last one logged if there are fewer.
+            approx_delta_model_grad_mags = log_parser.parse_approx_delta_model_log(
+                os.path.join(run["approx_delta_model_run_dir"], "out_server.txt"))
+            run_df["approx_delta_model_grad_mag"] = [
+                approx_delta_model_grad_mags[min(time_step, len(approx_delta_model_grad_mags) - 1)]
+                for time_step in run_df.time_step]
+
+    run_df.to_csv(os.path.join(run["run_path"], "run.csv"), index=False)
+
+    for column in reversed(RUN_COLUMNS):
+        run_df.insert(0, column, run[column])
+    return run_df
+
+
+def time_step_dir(parent_dir, time_step):
+    """
+    Get the directory of a time step, named with or without zero padding.
+    """
+    padded_dir = os.path.join(parent_dir, str(time_step).zfill(2))
+    if os.path.isdir(padded_dir):
+        return padded_dir
+    return os.path.join(parent_dir, str(time_step))
+
+
+def index_results(results_dir, truth_dir, jobs=1, cache_path=None, cache_tables=True):
+    """
+    Parse every run in the results tree into one table with one row per run and time step.
+    :param jobs: The number of processes that parse runs concurrently.
+    :param cache_path: The metrics cache, by default metrics_cache.sqlite in results_dir.
+    :param cache_tables: Cache the parsed logs as Parquet tables next to them, if a Parquet engine is installed.
+    """
+    runs = [run for run in enumerate_runs(results_dir) if os.path.isdir(run["run_path"])]
+    arguments = [(run, truth_dir, cache_path, cache_tables) for run in runs]
+
+    if jobs <= 1:
+        run_dfs = [_parse_run_worker(*run_arguments) for run_arguments in arguments]
+    else:
+        with Pool(jobs) as pool:
+            run_dfs = pool.starmap(_parse_run_worker, arguments)
+
+    run_dfs = [run_df for run_df in run_dfs if run_df is not None]
+    if len(run_dfs) == 0:
+        return pd.DataFrame(columns=RUN_COLUMNS)
+    return pd.concat(run_dfs, ignore_index=True, sort=False)
+
+
+def _parse_run_worker(run, truth_dir, cache_path, cache_tables):
+    try:
+        return parse_run(run, truth_dir, cache_path=cache_path, cache_tables=cache_tables)
+    except FileNotFoundError as err:
+        print(err)
+        return None
+
+
+def main(results_dir, truth_dir, output_path, jobs, cache_path):
+    results_df = index_results(results_dir, truth_dir, jobs=jobs, cache_path=cache_path)
+    results_df.to_csv(output_path, index=False)
+
+
+def _load_args(args):
+    executable = args.pop(0)
+
+    jobs = 1
+    cache_path = None
+    positional_args = []
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg in ('--jobs', '-j') and len(args) > 0:
+            jobs = int(args.pop(0))
+        elif arg == '--cache-path' and len(args) > 0:
+            cache_path = args.pop(0)
+        else:
+            positional_args.append(arg)
+
+    if len(positional_args) != 3 or ({'h', 'help'} & {arg.lower().strip().replace('-', '') for arg in positional_args}):
+        print("USAGE: python3 %s <results_dir> <truth_data_dir> <output_path> [--jobs <jobs>] [--cache-path <path>]"
+              % (executable),
+              file=sys.stderr)
+        sys.exit(1)
+
+    results_dir, truth_dir, output_path = positional_args
+    return results_dir, truth_dir, output_path, jobs, cache_path
+
+
+if __name__ == '__main__':
+    results_dir, truth_dir, output_path, jobs, cache_path = _load_args(sys.argv)
+    main(results_dir, truth_dir, output_path, jobs, cache_path)
@@ -180,7 +180,8 @@ function run_offline() {
 
          if [ $initialization == "ATOM" ] && [ $split != "00" ]; then
            # Join inferred predicates and split predicates to one file. Keep inferred predicates.
-           join_experiment_results "${out_directory}/inferred-predicates/${prev_split}/${EXAMPLE_INFERRED_FILE[${example_name}]}" "../data/${example_name}/${variant}/${fold}/eval/${split}/${EXAMPLE_TARGET_FILE[${example_name}]}"
+           # Seed the random fill values of the hot start by fold and split so runs are reproducible.
+           join_experiment_results "${out_directory}/inferred-predicates/${prev_split}/${EXAMPLE_INFERRED_FILE[${example_name}]}" "../data/${example_name}/${variant}/${fold}/eval/${split}/${EXAMPLE_TARGET_FILE[${example_name}]}" "$(( 10#${fold} * 1000 + 10#${split} ))"
            # Set the target file.
            sed -i "s@${split_targets_path}@${split_targets_dir}/hotstart_target.txt@g" "${example_name}-eval.data"
          else
@@ -336,8 +337,9 @@ function run_regret() {
 function join_experiment_results() {
   local inferred_predicates_path=$1
   local split_targets_path=$2
+  local seed=$3
 
-  python3 "${BASE_DIR}"/join_experiment_results.py $(realpath ${inferred_predicates_path}) $(realpath ${split_targets_path})
+  python3 "${BASE_DIR}"/join_experiment_results.py $(realpath ${inferred_predicates_path}) $(realpath ${split_targets_path}) --seed ${seed}
 }
 
 function experiment_one() {
@@ -183,7 +183,8 @@ function run_offline() {
 
          if [ $initialization == "ATOM" ]; then
            # Join inferred predicates and split predicates to one file. Keep inferred predicates.
-           join_experiment_results "${out_directory}/inferred-predicates/${prev_model}/${EXAMPLE_INFERRED_FILE[${example_name}]}" "../data/${example_name}/${fold}/eval/${EXAMPLE_TARGET_FILE[${example_name}]}"
+           # Seed the random fill values of the hot start by fold and model so runs are reproducible.
+           join_experiment_results "${out_directory}/inferred-predicates/${prev_model}/${EXAMPLE_INFERRED_FILE[${example_name}]}" "../data/${example_name}/${fold}/eval/${EXAMPLE_TARGET_FILE[${example_name}]}" "$(echo "${fold}/${model_name}" | cksum | cut -f 1 -d ' ')"
            # Set the target file.
            sed -i "s@${targets_path}@${targets_dir}/hotstart_target.txt@g" "${example_name}-eval.data"
          else
@@ -290,8 +291,9 @@ function run_regret() {
 function join_experiment_results() {
   local inferred_predicates_path=$1
   local targets_path=$2
+  local seed=$3
 
-  python3 "${BASE_DIR}"/join_experiment_results.py $(realpath ${inferred_predicates_path}) $(realpath ${targets_path})
+  python3 "${BASE_DIR}"/join_experiment_results.py $(realpath ${inferred_predicates_path}) $(realpath ${targets_path}) --seed ${seed}
 }
 
 function experiment_one() {